@@ -1,21 +1,33 @@
 #!/usr/bin/env python3
 import argparse
+import atexit
 import bz2
+import concurrent.futures
+import contextlib
 import gzip
 import hashlib
+import itertools
+import json
 import logging
 import lzma
 import os
 import re
 import shutil
 import socket
+import sqlite3
+import sys
+import tempfile
+import threading
 import time
 import traceback
+import urllib.parse
+from collections import OrderedDict
 from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import IO, Any, Dict, Iterator, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter, Retry
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -53,12 +65,29 @@ ARCH_NO_PKGIDX = ["dep11", "i18n", "cnf", "neon"]
 MAX_RETRY = int(os.getenv("MAX_RETRY", "3"))
 DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "1800"))
 REPO_SIZE_FILE = os.getenv("REPO_SIZE_FILE", "")
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+BY_HASH_RETENTION = int(os.getenv("BY_HASH_RETENTION", str(2 * 86400)))
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", str(64 * 1024**2)))
+# directory of package files keyed by SHA256, shared by mirrors on the same filesystem
+CONTENT_STORE = os.getenv("CONTENT_STORE", "")
+# bytes per second over all workers, 0 for unlimited
+BANDWIDTH_LIMIT = int(os.getenv("BANDWIDTH_LIMIT", "0"))
+# concurrent connections to the same host over all workers, 0 for unlimited
+MAX_CONN_PER_HOST = int(os.getenv("MAX_CONN_PER_HOST", "0"))
+# smaller chunks keep a low bandwidth limit smooth
+DOWNLOAD_CHUNK_SIZE = (
+    min(1024**2, max(BANDWIDTH_LIMIT // 8, 16 * 1024)) if BANDWIDTH_LIMIT > 0 else 1024**2
+)
 
 pattern_os_template = re.compile(r"@\{(.+)\}")
-pattern_package_name = re.compile(r"^Filename: (.+)$", re.MULTILINE)
-pattern_package_size = re.compile(r"^Size: (\d+)$", re.MULTILINE)
-pattern_package_sha256 = re.compile(r"^SHA256: (\w{64})$", re.MULTILINE)
-download_cache = dict()
+pattern_package_sha256 = re.compile(r"^\w{64}$")
+pattern_ed_command = re.compile(rb"^(\d+)(?:,(\d+))?([acd])\n$")
+PKGIDX_OPENERS = {
+    ".xz": lzma.open,
+    ".bz2": bz2.open,
+    ".gz": gzip.open,
+    "": open,
+}
 
 
 def check_args(prop: str, lst: List[str]):
@@ -81,17 +110,453 @@ def replace_os_template(os_list: List[str]) -> List[str]:
     return ret
 
 
-def check_and_download(url: str, dst_file: Path, caching=False) -> int:
+session: requests.Session
+
+
+def setup_session(pool_size: int):
+    """
+    Share one session among all threads, keeping up to `pool_size` idle
+    connections per host alive. Connection errors and overloaded upstreams are
+    retried with backoff by the adapter, and check_and_download() counts these
+    retries. Callers only retry what the adapter cannot: transfers which broke
+    off midway or arrived corrupted.
+    """
+    global session
+    retries = Retry(
+        total=MAX_RETRY,
+        backoff_factor=1,
+        status_forcelist=[429, 502, 503, 504],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=16, pool_maxsize=pool_size, max_retries=retries
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+
+def connection_stats() -> Tuple[int, int]:
+    """
+    Return the number of requests sent and connections opened by the session
+    """
+    n_requests, n_connections = 0, 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                n_requests += pool.num_requests
+                n_connections += pool.num_connections
+    return n_requests, n_connections
+
+
+setup_session(1)
+
+
+class TokenBucket:
+    """
+    Bandwidth limit shared by all download threads. Tokens are bytes, refilled
+    at `rate` per second; at most one second worth of tokens is saved up.
+    A thread taking more tokens than available sleeps until the debt is paid
+    back, so the total rate never exceeds `rate` however many threads there are.
+    """
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n: int):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HostLimiter:
+    """
+    Caps the number of concurrent connections to each host over all threads.
+    """
+
+    def __init__(self, max_conn: int):
+        self.max_conn = max_conn
+        self.lock = threading.Lock()
+        self.semaphores: Dict[str, threading.BoundedSemaphore] = {}
+
+    def slot(self, url: str):
+        if self.max_conn <= 0:
+            return contextlib.nullcontext()
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.max_conn)
+            return self.semaphores[host]
+
+
+bandwidth_limiter = TokenBucket(BANDWIDTH_LIMIT)
+host_limiter = HostLimiter(MAX_CONN_PER_HOST)
+
+
+class MetadataCache:
+    """
+    Bounded on-disk cache of metadata files (InRelease, Release, Release.gpg)
+    downloaded in this run, keyed by URL. Upstream is asked only once per run,
+    so that all jobs of a dist see the same Release even if upstream changes
+    meanwhile; conditional requests against the published copy are handled
+    by ValidatorStore. Least recently used entries are evicted once the total
+    size exceeds `max_size`.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.lock = threading.Lock()
+        self.url_locks: Dict[str, threading.Lock] = {}
+        self.entries: "OrderedDict[str, Tuple[Path, int]]" = OrderedDict()
+        self.cache_dir: Optional[Path] = None
+
+    def url_lock(self, url: str) -> threading.Lock:
+        with self.lock:
+            return self.url_locks.setdefault(url, threading.Lock())
+
+    def fetch(self, url: str, dst_file: Path) -> bool:
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return False
+            self.entries.move_to_end(url)
+            link_or_copy(entry[0], dst_file)
+            return True
+
+    def put(self, url: str, src_file: Path):
+        size = src_file.stat().st_size
+        if size > self.max_size:
+            return
+        with self.lock:
+            if self.cache_dir is None:
+                self.cache_dir = Path(tempfile.mkdtemp(prefix="apt-sync-cache."))
+                atexit.register(shutil.rmtree, str(self.cache_dir), True)
+            self._discard(url)
+            cached = self.cache_dir / hashlib.sha256(url.encode()).hexdigest()
+            link_or_copy(src_file, cached)
+            self.entries[url] = (cached, size)
+            self.size += size
+            while self.size > self.max_size:
+                self._discard(next(iter(self.entries)))
+
+    def discard(self, url: str):
+        with self.lock:
+            self._discard(url)
+
+    def _discard(self, url: str):
+        entry = self.entries.pop(url, None)
+        if entry is not None:
+            entry[0].unlink()
+            self.size -= entry[1]
+
+
+metadata_cache = MetadataCache(METADATA_CACHE_SIZE)
+
+
+class ValidatorStore:
+    """
+    HTTP validators (ETag, Last-Modified) and SHA256 digests of the metadata files
+    published in the mirror, and the Release checksum of every dist/component/arch
+    that was last synced successfully, kept between runs.
+
+    A validator or digest is only used while the local file still has the size
+    and mtime it had when it was recorded.
+    """
+
+    def __init__(self):
+        self.path: Optional[Path] = None
+        self.lock = threading.Lock()
+        self.urls: Dict[str, Dict[str, Any]] = {}
+        self.digests: Dict[str, Tuple[int, int, str]] = {}
+        self.done: Dict[str, str] = {}
+
+    def load(self, path: Path):
+        self.path = path
+        if not path.is_file():
+            return
+        try:
+            with path.open("r") as f:
+                content = json.load(f)
+            self.urls = content.get("urls", {})
+            self.digests = {k: tuple(v) for k, v in content.get("digests", {}).items()}
+            self.done = content.get("done", {})
+        except:
+            logger.warning(f"Ignoring broken validator file {path}")
+            traceback.print_exc()
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with tmp_path.open("w") as f:
+                json.dump(
+                    {"urls": self.urls, "digests": self.digests, "done": self.done}, f
+                )
+            tmp_path.rename(self.path)
+
+    def headers(self, url: str, local_file: Path) -> Dict[str, str]:
+        with self.lock:
+            entry = self.urls.get(url)
+        if entry is None or not local_file.is_file():
+            return {}
+        st = local_file.stat()
+        if st.st_size != entry["size"] or int(st.st_mtime) != entry["mtime"]:
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last-modified"):
+            headers["If-Modified-Since"] = entry["last-modified"]
+        return headers
+
+    def update(self, url: str, headers, local_file: Path):
+        if self.path is None:
+            return
+        if "etag" not in headers and "last-modified" not in headers:
+            return
+        st = local_file.stat()
+        with self.lock:
+            self.urls[url] = {
+                "etag": headers.get("etag"),
+                "last-modified": headers.get("last-modified"),
+                "size": st.st_size,
+                "mtime": int(st.st_mtime),
+            }
+
+    def digest(self, key: str, local_file: Path) -> Optional[str]:
+        st = local_file.stat()
+        with self.lock:
+            entry = self.digests.get(key)
+        if entry is None or entry[0] != st.st_size or entry[1] != int(st.st_mtime):
+            return None
+        return entry[2]
+
+    def set_digest(self, key: str, local_file: Path, checksum: str):
+        st = local_file.stat()
+        with self.lock:
+            self.digests[key] = (st.st_size, int(st.st_mtime), checksum)
+
+    def is_done(self, key: str, release_checksum: str) -> bool:
+        with self.lock:
+            return self.done.get(key) == release_checksum
+
+    def mark_done(self, key: str, release_checksum: Optional[str]):
+        with self.lock:
+            if release_checksum is None:
+                self.done.pop(key, None)
+            else:
+                self.done[key] = release_checksum
+
+
+validators = ValidatorStore()
+
+
+def link_or_copy(src: Path, dst: Path):
+    if dst.exists():
+        dst.unlink()
     try:
-        if caching:
-            if url in download_cache:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class JobStats:
+    """
+    Counters of one apt_mirror() call, exported by write_metrics()
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.downloaded_bytes = 0
+        self.packages = 0
+        self.fetched = 0
+        self.linked = 0
+        self.failed = 0
+        self.checksum_failures = 0
+        self.retries = 0
+        self.index_seconds = 0.0
+        self.package_seconds = 0.0
+        self.success = False
+
+    def add(self, **kwargs):
+        with self.lock:
+            for key, value in kwargs.items():
+                setattr(self, key, getattr(self, key) + value)
+
+
+METRICS = [
+    # name, help, getter
+    ("downloaded_bytes", "Bytes downloaded in the last run", lambda s: s.downloaded_bytes),
+    ("packages", "Packages referenced by the index", lambda s: s.packages),
+    ("packages_fetched", "Packages downloaded in the last run", lambda s: s.fetched),
+    ("packages_linked", "Packages linked from CONTENT_STORE in the last run", lambda s: s.linked),
+    (
+        "packages_skipped",
+        "Packages already present in the last run",
+        lambda s: s.packages - s.fetched - s.linked - s.failed,
+    ),
+    ("packages_failed", "Packages that could not be downloaded in the last run", lambda s: s.failed),
+    ("checksum_failures", "Downloads with a wrong SHA256 in the last run", lambda s: s.checksum_failures),
+    ("retries", "Download attempts after the first one in the last run", lambda s: s.retries),
+    ("index_fetch_seconds", "Time spent on Release and index files in the last run", lambda s: s.index_seconds),
+    ("package_fetch_seconds", "Time spent on package files in the last run", lambda s: s.package_seconds),
+    (
+        "throughput_bytes_per_second",
+        "Bytes downloaded per second in the last run",
+        lambda s: s.downloaded_bytes / max(s.index_seconds + s.package_seconds, 1e-3),
+    ),
+    ("success", "Whether the last run succeeded", lambda s: int(s.success)),
+]
+
+
+def write_metrics(
+    path: str,
+    base_url: str,
+    all_stats: Dict[Tuple[str, str, str], JobStats],
+    connections: Tuple[int, int] = (0, 0),
+):
+    """
+    Write the stats of the last run in the node_exporter textfile format
+    """
+
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    lines = []
+    for name, help, getter in METRICS:
+        lines.append(f"# HELP apt_sync_{name} {help}")
+        lines.append(f"# TYPE apt_sync_{name} gauge")
+        for (dist, comp, arch), stats in all_stats.items():
+            labels = ",".join(
+                f'{k}="{escape(v)}"'
+                for k, v in (
+                    ("base_url", base_url),
+                    ("dist", dist),
+                    ("component", comp),
+                    ("arch", arch),
+                )
+            )
+            lines.append(f"apt_sync_{name}{{{labels}}} {getter(stats)}")
+    for name, help, value in (
+        ("http_requests", "HTTP requests sent in the last run", connections[0]),
+        ("http_connections", "HTTP connections opened in the last run", connections[1]),
+    ):
+        lines.append(f"# HELP apt_sync_{name} {help}")
+        lines.append(f"# TYPE apt_sync_{name} gauge")
+        lines.append(f'apt_sync_{name}{{base_url="{escape(base_url)}"}} {value}')
+    lines.append("# HELP apt_sync_last_run_timestamp_seconds End time of the last run")
+    lines.append("# TYPE apt_sync_last_run_timestamp_seconds gauge")
+    lines.append(
+        f'apt_sync_last_run_timestamp_seconds{{base_url="{escape(base_url)}"}} {time.time()}'
+    )
+    # node_exporter may read the file at any time, so replace it atomically
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.rename(tmp_path, path)
+
+
+class ResumeState:
+    """
+    Progress of a partially downloaded file, carried over between retries:
+    the running SHA256 of the bytes on disk, and the validator for If-Range.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sha = hashlib.sha256()
+        self.offset = 0
+        self.validator: Optional[str] = None
+
+
+def check_and_download(
+    url: str,
+    dst_file: Path,
+    caching=False,
+    size: Optional[int] = None,
+    sha=None,
+    local_file: Optional[Path] = None,
+    resume: Optional[ResumeState] = None,
+    stats: Optional[JobStats] = None,
+) -> int:
+    """
+    If `size` is given, the download is aborted as soon as more bytes than
+    expected arrive. If a hashlib object is given as `sha`, it is updated with
+    every chunk written, so that the caller can verify the file without
+    reading it again.
+    If `local_file` is the currently published copy of `url`, a conditional
+    request is sent and `local_file` is reused when upstream answers 304.
+    If `resume` is given, a failed download keeps its partial file and the next
+    call with the same state only requests the missing bytes; `resume.sha`
+    is then used instead of `sha`.
+    Downloaded bytes are counted in `stats`, if given.
+    Returns 0 on success, 1 if the request failed, or 2 if the transfer broke
+    off or its content does not match `size`.
+    """
+    args = (url, dst_file, caching, size, sha, local_file, resume, stats)
+    if caching:
+        # concurrent jobs of the same dist must not see a half-written cache entry
+        with metadata_cache.url_lock(url):
+            if metadata_cache.fetch(url, dst_file):
                 logger.info(f"Using cached content: {url}")
-                with dst_file.open("wb") as f:
-                    f.write(download_cache[url])
                 return 0
-            download_cache[url] = bytes()
+            with host_limiter.slot(url):
+                return _check_and_download(*args)
+    with host_limiter.slot(url):
+        return _check_and_download(*args)
+
+
+def _check_and_download(
+    url: str,
+    dst_file: Path,
+    caching: bool,
+    size: Optional[int],
+    sha,
+    local_file: Optional[Path],
+    resume: Optional[ResumeState],
+    stats: Optional[JobStats],
+) -> int:
+    transferring = False
+    try:
         start = time.time()
-        with requests.get(url, stream=True, timeout=(30, 60)) as r:
+        headers = validators.headers(url, local_file) if local_file else {}
+        if resume is not None and resume.offset > 0:
+            logger.info(f"Resuming {url} from byte {resume.offset}")
+            headers["Range"] = f"bytes={resume.offset}-"
+            headers["If-Range"] = resume.validator
+        with session.get(
+            url, stream=True, timeout=(30, 60), headers=headers
+        ) as r:
+            if stats is not None and r.raw.retries is not None:
+                stats.add(retries=len(r.raw.retries.history))
+            if r.status_code == 304 and len(headers) > 0:
+                logger.info(f"Not modified: {url}")
+                link_or_copy(local_file, dst_file)
+                if size is not None and dst_file.stat().st_size != size:
+                    raise ValueError(f"Invalid size of {local_file}, expected {size}")
+                if sha is not None:
+                    with dst_file.open("rb") as f:
+                        for block in iter(lambda: f.read(1024**2), b""):
+                            sha.update(block)
+                if caching:
+                    metadata_cache.put(url, dst_file)
+                return 0
             r.raise_for_status()
             if "last-modified" in r.headers:
                 remote_ts = parsedate_to_datetime(
@@ -100,30 +565,111 @@ def check_and_download(url: str, dst_file: Path, caching=False) -> int:
             else:
                 remote_ts = None
 
-            with dst_file.open("wb") as f:
-                for chunk in r.iter_content(chunk_size=1024**2):
+            received = 0
+            mode = "wb"
+            if resume is not None:
+                if r.status_code == 206 and r.headers.get(
+                    "content-range", ""
+                ).startswith(f"bytes {resume.offset}-"):
+                    received = resume.offset
+                    mode = "ab"
+                else:
+                    resume.reset()  # upstream sent the whole file
+                sha = resume.sha
+                # If-Range needs a strong ETag or a Last-Modified date
+                etag = r.headers.get("etag", "")
+                resume.validator = (
+                    etag
+                    if etag and not etag.startswith("W/")
+                    else r.headers.get("last-modified")
+                )
+            if mode == "wb" and dst_file.exists():
+                dst_file.unlink()  # never write into a file shared with the cache
+            transferring = True
+            with dst_file.open(mode) as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
                     if time.time() - start > DOWNLOAD_TIMEOUT:
                         raise TimeoutError("Download timeout")
                     if not chunk:
                         continue  # filter out keep-alive new chunks
 
+                    bandwidth_limiter.consume(len(chunk))
+                    received += len(chunk)
+                    if size is not None and received > size:
+                        raise ValueError(f"Size exceeded, expected {size}")
                     f.write(chunk)
-                    if caching:
-                        download_cache[url] += chunk
+                    if sha is not None:
+                        sha.update(chunk)
+                    if resume is not None:
+                        resume.offset = received
+                    if stats is not None:
+                        stats.add(downloaded_bytes=len(chunk))
+            if size is not None and received != size:
+                raise ValueError(f"Invalid size {received}, expected {size}")
             if remote_ts is not None:
                 os.utime(dst_file, (remote_ts, remote_ts))
+            if local_file is not None:
+                validators.update(url, r.headers, dst_file)
+            if caching:
+                metadata_cache.put(url, dst_file)
         return 0
     except BaseException as e:
         logger.error(f"Error occurred: {e}")
+        ret = 2 if transferring or isinstance(e, ValueError) else 1
+        if (
+            resume is not None
+            and resume.offset > 0
+            and resume.validator
+            and not isinstance(e, ValueError)
+            and dst_file.is_file()
+        ):
+            # keep exactly the bytes covered by the running hash
+            os.truncate(dst_file, resume.offset)
+            return ret
+        if resume is not None:
+            resume.reset()
         if dst_file.is_file():
             dst_file.unlink()
-        if url in download_cache:
-            del download_cache[url]
-    return 1
+        if caching:
+            metadata_cache.discard(url)
+        return ret
+
+
+def parse_pkgidx(fd: IO[bytes]) -> Iterator[Optional[Tuple[str, int, str]]]:
+    """
+    Incrementally parse a (decompressed) Packages index, yielding
+    (Filename, Size, SHA256) of each stanza, or None if the stanza is broken.
+    """
+    fields = {}
+    lines = 0
+    for line in itertools.chain(fd, [b"\n"]):
+        line = line.rstrip(b"\r\n")
+        if len(line) == 0:
+            if lines == 0:
+                continue  # ignore blanks
+            try:
+                filename = fields[b"Filename"]
+                size = int(fields[b"Size"])
+                checksum = fields[b"SHA256"]
+                if not pattern_package_sha256.match(checksum):
+                    raise ValueError(f"Invalid SHA256 {checksum}")
+                yield (filename, size, checksum)
+            except:
+                traceback.print_exc()
+                yield None
+            fields.clear()
+            lines = 0
+            continue
+        lines += 1
+        if line[0] in b" \t":
+            continue  # continuation of a multi-line field
+        key, sep, value = line.partition(b":")
+        if sep and key in (b"Filename", b"Size", b"SHA256"):
+            fields[key] = value.strip().decode("utf-8")
 
 
-def mkdir_with_dot_tmp(folder: Path) -> Tuple[Path, Path]:
-    tmpdir = folder / ".tmp"
+def mkdir_with_dot_tmp(folder: Path, tmp_name: str = ".tmp") -> Tuple[Path, Path]:
+    tmpdir = folder / tmp_name
     if tmpdir.is_dir():
         shutil.rmtree(str(tmpdir))
     tmpdir.mkdir(parents=True, exist_ok=True)
@@ -140,12 +686,676 @@ def move_files_in(src: Path, dst: Path):
             (dst / file.name).mkdir(parents=True, exist_ok=True)
             move_files_in(file, dst / file.name)
             file.rmdir()  # rmdir wont fail as all files in it have been moved
+        elif (dst / file.name).exists() and file.samefile(dst / file.name):
+            file.unlink()  # reused from the published tree via hardlink
         else:
             file.rename(dst / file.name)  # Overwrite files
     if empty:
         logger.info(f"{src} is empty")
 
 
+def file_sha256(path: Path) -> str:
+    sha = hashlib.sha256()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1024**2), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class PDiffIndex:
+    """
+    SHA256 fields of a Packages.diff/Index file, see
+    https://wiki.debian.org/DebianRepository/Format#diff_Index
+    """
+
+    def __init__(self, path: Path):
+        self.current: Optional[Tuple[str, int]] = None
+        # (checksum, size, patch name) of the file each patch applies to, oldest first
+        self.history: List[Tuple[str, int, str]] = []
+        # patch name -> (checksum, size, file name) of the compressed patch
+        self.downloads: Dict[str, Tuple[str, int, str]] = {}
+        # each patch leads to the current version directly
+        self.merged = False
+        field = None
+        with path.open("r") as f:
+            for line in f:
+                if line[:1].isspace():
+                    parts = line.split()
+                    if len(parts) != 3:
+                        continue
+                    checksum, size, name = parts[0], int(parts[1]), parts[2]
+                    if field == "SHA256-History":
+                        self.history.append((checksum, size, name))
+                    elif field == "SHA256-Download":
+                        patch_name = name[:-3] if name.endswith(".gz") else name
+                        self.downloads[patch_name] = (checksum, size, name)
+                    continue
+                field, _, value = line.partition(":")
+                value = value.strip()
+                if field == "SHA256-Current":
+                    checksum, size = value.split()
+                    self.current = (checksum, int(size))
+                elif field == "X-Patch-Precedence":
+                    self.merged = value == "merged"
+
+    def patches_for(self, checksum: str, size: int) -> Optional[List[str]]:
+        for i, (c, s, _) in enumerate(self.history):
+            if (c, s) == (checksum, size):
+                names = [h[2] for h in self.history[i:]]
+                return names[:1] if self.merged else names
+        return None
+
+
+def apply_ed_patch(src: IO[bytes], dst: IO[bytes], patch: IO[bytes]):
+    """
+    Apply an ed script as written by `diff --ed`, with commands ordered from
+    the end of the file, streaming `src` into `dst`.
+    """
+    hunks = []
+    for command in patch:
+        matched = pattern_ed_command.match(command)
+        if matched is None:
+            raise ValueError(f"Unsupported ed command {command!r}")
+        start = int(matched.group(1))
+        end = int(matched.group(2) or start)
+        op = matched.group(3)
+        text = []
+        if op != b"d":
+            for line in patch:
+                if line == b".\n":
+                    break
+                text.append(line)
+            else:
+                raise ValueError("Unterminated ed command")
+        hunks.append((start, end, op, text))
+
+    lineno = 0  # lines of src consumed
+
+    def copy_until(n: int):
+        nonlocal lineno
+        if n < lineno:
+            raise ValueError("ed commands out of order")
+        while lineno < n:
+            line = src.readline()
+            if not line:
+                raise ValueError("ed command beyond the end of the file")
+            dst.write(line)
+            lineno += 1
+
+    for start, end, op, text in reversed(hunks):
+        if op == b"a":
+            copy_until(start)
+        else:
+            copy_until(start - 1)
+            for _ in range(end - start + 1):
+                if not src.readline():
+                    raise ValueError("ed command beyond the end of the file")
+                lineno += 1
+        dst.writelines(text)
+    shutil.copyfileobj(src, dst)
+
+
+def apt_pdiff_update(
+    diff_url: str,
+    diff_index: Path,
+    local_file: Path,
+    dst_file: Path,
+    size: int,
+    checksum: str,
+    stats: Optional[JobStats] = None,
+) -> bool:
+    """
+    Rebuild an uncompressed index file from its previous version `local_file`
+    and the patches listed in `diff_index`, checking the result against the
+    size and SHA256 from Release. Returns False if the file has to be
+    downloaded in full instead.
+
+    `local_file` only exists if upstream served the uncompressed file once.
+    Upstreams like dak do not, and patching would save nothing there: the
+    compressed variants have to be downloaded in full anyway.
+    """
+    try:
+        index = PDiffIndex(diff_index)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Invalid PDiff index {diff_index}: {e}")
+        return False
+    if index.current != (checksum, size):
+        return False
+
+    names = index.patches_for(file_sha256(local_file), local_file.stat().st_size)
+    if names is None or any(name not in index.downloads for name in names):
+        logger.info(f"No PDiff patch chain from {local_file}, downloading in full")
+        return False
+
+    with tempfile.TemporaryDirectory(dir=dst_file.parent, prefix=".pdiff.") as tmp:
+        current = local_file
+        for i, name in enumerate(names):
+            patch_checksum, patch_size, patch_filename = index.downloads[name]
+            patch_file = Path(tmp) / patch_filename
+            sha = hashlib.sha256()
+            if (
+                check_and_download(
+                    f"{diff_url}/{patch_filename}",
+                    patch_file,
+                    size=patch_size,
+                    sha=sha,
+                    stats=stats,
+                )
+                != 0
+                or sha.hexdigest() != patch_checksum
+            ):
+                logger.warning(f"Failed to fetch PDiff patch {patch_filename}")
+                return False
+            result = Path(tmp) / f"step.{i}"
+            try:
+                with current.open("rb") as src, result.open("wb") as dst, gzip.open(
+                    patch_file, "rb"
+                ) as patch:
+                    apply_ed_patch(src, dst, patch)
+            except (OSError, EOFError, ValueError) as e:
+                logger.warning(f"Failed to apply PDiff patch {patch_filename}: {e}")
+                return False
+            current = result
+        if current.stat().st_size != size or file_sha256(current) != checksum:
+            logger.warning(f"Invalid checksum after applying PDiff patches to {local_file}")
+            return False
+        current.rename(dst_file)
+    logger.info(f"Updated {local_file.name} with {len(names)} PDiff patches")
+    return True
+
+
+def index_file_present(key: str, local_file: Path, size: int, checksum: str) -> bool:
+    """
+    Check an index file against the size and SHA256 from Release, hashing it
+    only if there is no digest recorded for its current size and mtime.
+    """
+    if not local_file.is_file() or local_file.stat().st_size != size:
+        return False
+    digest = validators.digest(key, local_file)
+    if digest is None:
+        digest = file_sha256(local_file)
+        validators.set_digest(key, local_file, digest)
+    return digest == checksum
+
+
+def prune_by_hash(by_hash_dir: Path):
+    # by-hash files no longer linked to any index file are kept for a while, for
+    # clients which still have the previous InRelease
+    # jobs of the same component prune the same directories concurrently, so
+    # files may disappear meanwhile
+    now = time.time()
+    try:
+        files = list(by_hash_dir.iterdir())
+    except FileNotFoundError:
+        return
+    for file in files:
+        try:
+            st = file.stat()
+            if st.st_nlink == 1 and now - st.st_ctime > BY_HASH_RETENTION:
+                logger.info(f"Deleting old by-hash file {file}")
+                file.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def clone_tree(src: Path, dst: Path):
+    # hardlink every file of `src` into `dst`, leaving out staging directories
+    dst.mkdir(parents=True, exist_ok=True)
+    with os.scandir(src) as it:
+        for entry in it:
+            if entry.name.startswith(".tmp"):
+                continue
+            target = dst / entry.name
+            if entry.is_symlink():
+                os.symlink(os.readlink(entry.path), target)
+            elif entry.is_dir():
+                clone_tree(Path(entry.path), target)
+            else:
+                link_or_copy(Path(entry.path), target)
+
+
+class SnapshotPublisher:
+    """
+    Publishes each dists/<dist> as a whole. Jobs move their files into a
+    staging copy of the published tree, dists/.snapshots/<dist>/<id>, and
+    publish() switches the dists/<dist> symlink to it with a single rename.
+
+    by-hash directories are symlinks to dists/.by-hash/<dist>/..., shared by
+    all snapshots, so that by-hash files outlive the snapshot which referenced
+    them and are pruned by prune_by_hash() as usual.
+    """
+
+    def __init__(self, dest_base_dir: Path):
+        self.dists_dir = dest_base_dir / "dists"
+        self.lock = threading.Lock()
+        self.staging: Dict[str, Path] = {}
+
+    def snapshots_dir(self, dist: str) -> Path:
+        return self.dists_dir / ".snapshots" / dist.replace("/", "_")
+
+    def stage(self, dist: str) -> Path:
+        with self.lock:
+            if dist not in self.staging:
+                snapshots_dir = self.snapshots_dir(dist)
+                snapshots_dir.mkdir(parents=True, exist_ok=True)
+                staging = Path(tempfile.mkdtemp(dir=snapshots_dir))
+                staging.chmod(0o755)  # mkdtemp() creates it private
+                published = self.dists_dir / dist
+                if published.is_dir():
+                    logger.info(f"Staging a snapshot of {published} in {staging}")
+                    clone_tree(published, staging)
+                self.staging[dist] = staging
+            return self.staging[dist]
+
+    def discard(self, dist: str):
+        staging = self.staging.pop(dist, None)
+        if staging is not None:
+            logger.warning(f"Not publishing {dist}, discarding {staging}")
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def publish(self, dist: str) -> int:
+        staging = self.staging.pop(dist, None)
+        if staging is None:
+            return 0
+        published = self.dists_dir / dist
+        by_hash_root = self.dists_dir / ".by-hash" / dist
+        try:
+            # by-hash files must be in place before the new InRelease is visible
+            for by_hash_dir in list(staging.glob("**/by-hash")):
+                if by_hash_dir.is_symlink():
+                    continue
+                store = by_hash_root / by_hash_dir.relative_to(staging)
+                store.mkdir(parents=True, exist_ok=True)
+                move_files_in(by_hash_dir, store)
+                by_hash_dir.rmdir()
+                os.symlink(os.path.relpath(store, by_hash_dir.parent), by_hash_dir)
+
+            if published.is_dir() and not published.is_symlink():
+                # first snapshot of a directory published in place
+                legacy = Path(tempfile.mkdtemp(dir=staging.parent))
+                published.rename(legacy / "old")
+            link = staging.parent / ".link"
+            if link.is_symlink():
+                link.unlink()
+            os.symlink(os.path.relpath(staging, published.parent), link)
+            link.replace(published)
+            logger.info(f"Published {published} -> {staging}")
+        except:
+            traceback.print_exc()
+            shutil.rmtree(staging, ignore_errors=True)
+            return 1
+
+        for old in staging.parent.iterdir():
+            if old != staging and not old.is_symlink():
+                shutil.rmtree(old, ignore_errors=True)
+        for by_hash_dir in by_hash_root.glob("**/by-hash/SHA256"):
+            prune_by_hash(by_hash_dir)
+        return 0
+
+
+class ContentStore:
+    """
+    Package files of all mirrors using the same CONTENT_STORE, hardlinked as
+    <root>/sha256/<first 2 hex digits>/<SHA256>. Only files whose SHA256 has
+    been checked are added, so a file found here can be linked into a mirror
+    instead of being downloaded again.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def path(self, checksum: str) -> Path:
+        return self.root / "sha256" / checksum[:2] / checksum
+
+    def fetch(
+        self, checksum: str, size: int, dst_file: Path, verify: bool = False
+    ) -> bool:
+        """
+        Link the entry of `checksum` to `dst_file`. Entries are hardlinks to
+        mirror files and rot with them, so with `verify` the SHA256 of the
+        entry is checked first and a corrupted entry is removed.
+        """
+        src = self.path(checksum)
+        try:
+            if src.stat().st_size != size:
+                return False
+            if verify and file_sha256(src) != checksum:
+                logger.error(f"Invalid checksum of {src}, removing it from the content store")
+                self.discard(checksum)
+                return False
+            link_or_copy(src, dst_file)
+        except OSError:
+            return False
+        return True
+
+    def discard(self, checksum: str):
+        try:
+            self.path(checksum).unlink()
+        except FileNotFoundError:
+            pass
+
+    def usable_for(self, dest_base_dir: Path) -> bool:
+        # entries are hardlinks, copies across filesystems would save nothing
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            if self.root.stat().st_dev == dest_base_dir.stat().st_dev:
+                return True
+            logger.warning(
+                f"{self.root} is not on the filesystem of {dest_base_dir}, not using CONTENT_STORE"
+            )
+        except OSError as e:
+            logger.warning(f"Cannot use the content store {self.root}: {e}")
+        return False
+
+    def add(self, checksum: str, src: Path):
+        dst = self.path(checksum)
+        if dst.exists():
+            return
+        try:
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            os.link(src, dst)
+        except FileExistsError:
+            pass  # added by another process meanwhile
+        except OSError as e:
+            logger.warning(f"Cannot add {src} to the content store: {e}")
+
+
+content_store = ContentStore(Path(CONTENT_STORE)) if len(CONTENT_STORE) > 0 else None
+
+
+class SyncPlan:
+    """
+    Package files a sync would download and delete, collected in --plan mode
+    instead of changing the mirror
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fetch: Dict[str, int] = {}
+        self.delete: Dict[str, int] = {}
+
+    def add_fetch(self, path: str, size: int):
+        with self.lock:
+            self.fetch[path] = size
+
+    def add_delete(self, path: str, size: int):
+        with self.lock:
+            self.delete[path] = size
+
+    def write(
+        self,
+        path: str,
+        base_url: str,
+        all_stats: Dict[Tuple[str, str, str], JobStats],
+        failed: List[Tuple[str, str, str]],
+    ):
+        plan = {
+            "base_url": base_url,
+            "jobs": [
+                {
+                    "dist": dist,
+                    "component": comp,
+                    "arch": arch,
+                    "packages": stats.packages,
+                    "metadata_bytes": stats.downloaded_bytes,
+                    "success": (dist, comp, arch) not in failed,
+                }
+                for (dist, comp, arch), stats in all_stats.items()
+            ],
+            "fetch_files": len(self.fetch),
+            "fetch_bytes": sum(self.fetch.values()),
+            # deletions are only planned when all jobs succeeded
+            "delete_files": len(self.delete) if len(failed) == 0 else None,
+            "delete_bytes": sum(self.delete.values()) if len(failed) == 0 else None,
+            "fetch": [{"path": k, "size": v} for k, v in sorted(self.fetch.items())],
+            "delete": [{"path": k, "size": v} for k, v in sorted(self.delete.items())],
+        }
+        if path == "-":
+            json.dump(plan, sys.stdout, indent=1)
+            sys.stdout.write("\n")
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(plan, f, indent=1)
+        os.rename(tmp_path, path)
+
+
+class PoolIndex:
+    """
+    Pool files already verified during this run, shared by all apt_mirror() passes,
+    so that files referenced by several dists, components or archs are checked once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.verified: Dict[str, str] = {}
+        self.in_flight: Dict[str, threading.Event] = {}
+        self.duplicates = 0
+
+    def is_verified(self, path: str, checksum: str) -> bool:
+        with self.lock:
+            if self.verified.get(path) == checksum:
+                self.duplicates += 1
+                return True
+            return False
+
+    def add(self, path: str, checksum: str):
+        with self.lock:
+            self.verified[path] = checksum
+
+    def claim(self, path: str, checksum: str) -> bool:
+        """
+        Returns True if the caller should check/download the file and then call
+        release(), or False if another job has verified it in the meantime.
+        """
+        while True:
+            with self.lock:
+                if self.verified.get(path) == checksum:
+                    self.duplicates += 1
+                    return False
+                event = self.in_flight.get(path)
+                if event is None:
+                    self.in_flight[path] = threading.Event()
+                    return True
+            event.wait()
+
+    def release(self, path: str, checksum: str, ok: bool):
+        with self.lock:
+            if ok:
+                self.verified[path] = checksum
+            self.in_flight.pop(path).set()
+
+
+class PackageStateDB:
+    """
+    Persistent state of pool files: size, mtime, inode and the SHA256 the file is
+    known to have. `verified` is set only if that SHA256 was computed from the
+    file itself, rather than assumed from a matching size.
+    Files recorded here are not looked at again unless --full or --verify is
+    given, so a file removed outside apt-sync is not restored by a plain run.
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, path: Path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS packages (path TEXT PRIMARY KEY, size INTEGER, "
+            "mtime INTEGER, ino INTEGER, sha256 TEXT, verified INTEGER)"
+        )
+        self.conn.commit()
+        self.pending: List[Tuple[str, int, int, int, str, int]] = []
+
+    def lookup(self, paths: List[str]) -> Dict[str, Tuple[int, int, int, str, int]]:
+        ret = {}
+        with self.lock:
+            for i in range(0, len(paths), self.BATCH_SIZE):
+                chunk = paths[i : i + self.BATCH_SIZE]
+                for row in self.conn.execute(
+                    "SELECT path, size, mtime, ino, sha256, verified FROM packages "
+                    f"WHERE path IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ):
+                    ret[row[0]] = row[1:]
+        return ret
+
+    def record(self, path: str, st: os.stat_result, checksum: str, verified: bool):
+        with self.lock:
+            self.pending.append(
+                (path, st.st_size, st.st_mtime_ns, st.st_ino, checksum, int(verified))
+            )
+            if len(self.pending) >= self.BATCH_SIZE:
+                self._flush()
+
+    def forget(self, path: str):
+        with self.lock:
+            self._flush()
+            self.conn.execute("DELETE FROM packages WHERE path = ?", (path,))
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?, ?)", self.pending
+        )
+        self.conn.commit()
+        self.pending.clear()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def apt_download_package(
+    base_url: str,
+    pkg_filename: str,
+    pkg_size: int,
+    pkg_checksum: str,
+    dest_base_dir: Path,
+    pool_index: Optional[PoolIndex] = None,
+    state_db: Optional[PackageStateDB] = None,
+    state: Optional[Tuple[int, int, int, str, int]] = None,
+    verify: bool = False,
+    stats: Optional[JobStats] = None,
+) -> int:
+    args = (
+        base_url,
+        pkg_filename,
+        pkg_size,
+        pkg_checksum,
+        dest_base_dir,
+        state_db,
+        state,
+        verify,
+        stats if stats is not None else JobStats(),
+    )
+    if pool_index is None:
+        return _apt_download_package(*args)
+    if not pool_index.claim(pkg_filename, pkg_checksum):
+        return 0
+    ret = 1
+    try:
+        ret = _apt_download_package(*args)
+    finally:
+        pool_index.release(pkg_filename, pkg_checksum, ret == 0)
+    return ret
+
+
+def _apt_download_package(
+    base_url: str,
+    pkg_filename: str,
+    pkg_size: int,
+    pkg_checksum: str,
+    dest_base_dir: Path,
+    state_db: Optional[PackageStateDB],
+    state: Optional[Tuple[int, int, int, str, int]],
+    verify: bool,
+    stats: JobStats,
+) -> int:
+    dest_filename = dest_base_dir / pkg_filename
+    dest_dir = dest_filename.parent
+    if not dest_dir.is_dir():
+        dest_dir.mkdir(parents=True, exist_ok=True)
+    if dest_filename.is_file():
+        st = dest_filename.stat()
+        if st.st_size == pkg_size and not verify:
+            logger.info(f"Skipping {pkg_filename}, size {pkg_size}")
+            if state_db is not None:
+                state_db.record(pkg_filename, st, pkg_checksum, False)
+            return 0
+        if st.st_size == pkg_size:
+            # only re-hash files changed since they were last verified
+            if state is not None and state == (
+                st.st_size,
+                st.st_mtime_ns,
+                st.st_ino,
+                pkg_checksum,
+                1,
+            ):
+                logger.info(f"Skipping {pkg_filename}, verified before")
+                return 0
+            if file_sha256(dest_filename) == pkg_checksum:
+                logger.info(f"Verified {pkg_filename}")
+                if state_db is not None:
+                    state_db.record(pkg_filename, st, pkg_checksum, True)
+                if content_store is not None:
+                    content_store.add(pkg_checksum, dest_filename)
+                return 0
+            logger.error(f"Invalid checksum of {dest_filename}, downloading again")
+            if content_store is not None:
+                # the store entry may be a hardlink to the corrupted file
+                store_file = content_store.path(pkg_checksum)
+                if store_file.is_file() and store_file.samefile(dest_filename):
+                    content_store.discard(pkg_checksum)
+
+    pkg_url = f"{base_url}/{pkg_filename}"
+    dest_tmp_filename = dest_filename.with_name("._syncing_." + dest_filename.name)
+    if content_store is not None and content_store.fetch(
+        pkg_checksum, pkg_size, dest_tmp_filename, verify=verify
+    ):
+        logger.info(f"Linking {pkg_filename} from the content store")
+        dest_tmp_filename.rename(dest_filename)
+        if state_db is not None:
+            state_db.record(pkg_filename, dest_filename.stat(), pkg_checksum, False)
+        stats.add(linked=1)
+        return 0
+    resume = ResumeState()
+    for retry in range(MAX_RETRY):
+        logger.info(f"downloading {pkg_url} to {dest_filename}")
+        # break # dry run
+        if retry > 0:
+            stats.add(retries=1)
+        ret = check_and_download(
+            pkg_url, dest_tmp_filename, size=pkg_size, resume=resume, stats=stats
+        )
+        if ret == 1:
+            break  # already retried by the session
+        if ret != 0:
+            continue
+
+        if resume.sha.hexdigest() != pkg_checksum:
+            logger.error(f"Invalid checksum of {dest_filename}, expected {pkg_checksum}")
+            stats.add(checksum_failures=1)
+            dest_tmp_filename.unlink()
+            resume = ResumeState()
+            continue
+        dest_tmp_filename.rename(dest_filename)
+        if state_db is not None:
+            state_db.record(pkg_filename, dest_filename.stat(), pkg_checksum, True)
+        if content_store is not None:
+            content_store.add(pkg_checksum, dest_filename)
+        stats.add(fetched=1)
+        return 0
+    if dest_tmp_filename.is_file():
+        dest_tmp_filename.unlink()
+    logger.error(f"Failed to download {dest_filename}")
+    stats.add(failed=1)
+    return 1
+
+
 def apt_mirror(
     base_url: str,
     dist: str,
@@ -153,218 +1363,500 @@ def apt_mirror(
     arch: str,
     dest_base_dir: Path,
     deb_set: Dict[str, int],
+    workers: int = 1,
+    pool_index: Optional[PoolIndex] = None,
+    full: bool = False,
+    state_db: Optional[PackageStateDB] = None,
+    verify: bool = False,
+    stats: Optional[JobStats] = None,
+    publisher: Optional[SnapshotPublisher] = None,
+    plan: Optional[SyncPlan] = None,
 ) -> int:
     if not dest_base_dir.is_dir():
         logger.error("Destination directory is empty, cannot continue")
         return 1
     logger.info(f"Started mirroring {base_url} {dist}, {repo}, {arch}!")
+    if stats is None:
+        stats = JobStats()
+    start = time.time()
 
-    # download Release files
-    dist_dir, dist_tmp_dir = mkdir_with_dot_tmp(dest_base_dir / "dists" / dist)
-    check_and_download(
-        f"{base_url}/dists/{dist}/InRelease", dist_tmp_dir / "InRelease", caching=True
-    )
-    if (
+    with contextlib.ExitStack() as stack:
+        # nothing is created in the mirror when planning, index files are
+        # staged in a temporary directory instead
+        stage_base_dir = dest_base_dir
+        if plan is not None:
+            stage_dir = tempfile.TemporaryDirectory(prefix="apt-sync-plan.")
+            stage_base_dir = Path(stack.enter_context(stage_dir))
+
+        # every (repo, arch) pair gets its own staging directories, so that jobs
+        # sharing the same dist can run at the same time
+        tmp_name = ".tmp." + f"{repo}.{arch}".replace("/", "_")
+
+        # download Release files
+        dist_dir = dest_base_dir / "dists" / dist
+        stage_dist_dir, dist_tmp_dir = mkdir_with_dot_tmp(
+            stage_base_dir / "dists" / dist, tmp_name
+        )
         check_and_download(
-            f"{base_url}/dists/{dist}/Release", dist_tmp_dir / "Release", caching=True
+            f"{base_url}/dists/{dist}/InRelease",
+            dist_tmp_dir / "InRelease",
+            caching=True,
+            local_file=dist_dir / "InRelease",
         )
-        != 0
-    ):
-        logger.error("Invalid Repository")
-        if not (dist_dir / "Release").is_file():
-            logger.warning(
-                f"{dist_dir/'Release'} never existed, upstream may not provide packages for {dist}, ignore this error"
+        if (
+            check_and_download(
+                f"{base_url}/dists/{dist}/Release",
+                dist_tmp_dir / "Release",
+                caching=True,
+                local_file=dist_dir / "Release",
             )
-            return 0
-        return 1
-    check_and_download(
-        f"{base_url}/dists/{dist}/Release.gpg",
-        dist_tmp_dir / "Release.gpg",
-        caching=True,
-    )
+            != 0
+        ):
+            logger.error("Invalid Repository")
+            shutil.rmtree(str(dist_tmp_dir), ignore_errors=True)
+            if not (dist_dir / "Release").is_file():
+                logger.warning(
+                    f"{dist_dir/'Release'} never existed, upstream may not provide packages for {dist}, ignore this error"
+                )
+                return 0
+            return 1
+        check_and_download(
+            f"{base_url}/dists/{dist}/Release.gpg",
+            dist_tmp_dir / "Release.gpg",
+            caching=True,
+            local_file=dist_dir / "Release.gpg",
+        )
 
-    comp_dir, comp_tmp_dir = mkdir_with_dot_tmp(dist_dir / repo)
-
-    # load Package Index URLs from the Release file
-    release_file = dist_tmp_dir / "Release"
-    arch_dir = arch if arch in ARCH_NO_PKGIDX else f"binary-{arch}"
-    pkgidx_dir, pkgidx_tmp_dir = mkdir_with_dot_tmp(comp_dir / arch_dir)
-    with open(release_file, "r") as fd:
-        pkgidx_content = None
-        cnt_start = False
-        for line in fd:
-            if cnt_start:
-                fields = line.split()
-                if (
-                    len(fields) != 3 or len(fields[0]) != 64
-                ):  # 64 is SHA-256 checksum length
-                    break
-                checksum, filesize, filename = tuple(fields)
-                if (
-                    filename.startswith(f"{repo}/{arch_dir}/")
-                    or filename.startswith(f"{repo}/Contents-{arch}")
-                    or filename.startswith(f"Contents-{arch}")
-                ):
-                    fn = Path(filename)
-                    if len(fn.parts) <= 3:
-                        # Contents-amd64.gz
-                        # main/Contents-amd64.gz
-                        # main/binary-all/Packages
-                        pkgidx_file = dist_dir / fn.parent / ".tmp" / fn.name
+        comp_dir = dist_dir / repo
+        _, comp_tmp_dir = mkdir_with_dot_tmp(stage_dist_dir / repo, tmp_name)
+
+        # load Package Index URLs from the Release file
+        release_file = dist_tmp_dir / "Release"
+        with release_file.open("rb") as f:
+            release_checksum = hashlib.sha256(f.read()).hexdigest()
+        job_key = f"{base_url} {dist} {repo} {arch}"
+        # nothing to do if this Release has already been synced successfully
+        unchanged = (
+            plan is None and not full and validators.is_done(job_key, release_checksum)
+        )
+        if unchanged:
+            logger.info(f"Release of {dist} unchanged since last successful sync")
+        validators.mark_done(job_key, None)
+        idx_err = 0
+        arch_dir = arch if arch in ARCH_NO_PKGIDX else f"binary-{arch}"
+        pkgidx_dir = comp_dir / arch_dir
+        _, pkgidx_tmp_dir = mkdir_with_dot_tmp(
+            stage_dist_dir / repo / arch_dir, tmp_name
+        )
+        by_hash_dirs = set()
+        # (checksum, size, filename, staging path) of the index files to fetch
+        pkgidx_files: List[Tuple[str, int, str, Path]] = []
+        with open(release_file, "r") as fd:
+            cnt_start = False
+            acquire_by_hash = False
+            for line in fd:
+                if not cnt_start and line.startswith("Acquire-By-Hash:"):
+                    acquire_by_hash = line.split(":", 1)[1].strip().lower() == "yes"
+                if cnt_start:
+                    fields = line.split()
+                    if (
+                        len(fields) != 3 or len(fields[0]) != 64
+                    ):  # 64 is SHA-256 checksum length
+                        break
+                    checksum, filesize, filename = tuple(fields)
+                    if (
+                        filename.startswith(f"{repo}/{arch_dir}/")
+                        or filename.startswith(f"{repo}/Contents-{arch}")
+                        or filename.startswith(f"Contents-{arch}")
+                    ):
+                        fn = Path(filename)
+                        if plan is not None and not (
+                            fn.name.startswith("Packages")
+                            or filename.endswith("Packages.diff/Index")
+                        ):
+                            continue  # a plan only needs the package lists
+                        if len(fn.parts) <= 3:
+                            # Contents-amd64.gz
+                            # main/Contents-amd64.gz
+                            # main/binary-all/Packages
+                            pkgidx_file = (
+                                stage_dist_dir / fn.parent / tmp_name / fn.name
+                            )
+                        else:
+                            # main/dep11/by-hash/MD5Sum/0af5c69679a24671cfd7579095a9cb5e
+                            # deep_tmp_dir is in pkgidx_tmp_dir hence no extra garbage collection needed
+                            deep_tmp_dir = (
+                                stage_dist_dir
+                                / Path(fn.parts[0])
+                                / Path(fn.parts[1])
+                                / tmp_name
+                                / Path("/".join(fn.parts[2:-1]))
+                            )
+                            deep_tmp_dir.mkdir(parents=True, exist_ok=True)
+                            pkgidx_file = deep_tmp_dir / fn.name
                     else:
-                        # main/dep11/by-hash/MD5Sum/0af5c69679a24671cfd7579095a9cb5e
-                        # deep_tmp_dir is in pkgidx_tmp_dir hence no extra garbage collection needed
-                        deep_tmp_dir = (
-                            dist_dir
-                            / Path(fn.parts[0])
-                            / Path(fn.parts[1])
-                            / ".tmp"
-                            / Path("/".join(fn.parts[2:-1]))
-                        )
-                        deep_tmp_dir.mkdir(parents=True, exist_ok=True)
-                        pkgidx_file = deep_tmp_dir / fn.name
-                else:
-                    logger.warning(f"Ignore the file {filename}")
-                    continue
-                pkglist_url = f"{base_url}/dists/{dist}/{filename}"
-                if check_and_download(pkglist_url, pkgidx_file) != 0:
-                    logger.error(f"Failed to download: {pkglist_url}")
-                    continue
+                        logger.warning(f"Ignore the file {filename}")
+                        continue
+                    pkgidx_files.append(
+                        (checksum, int(filesize), filename, pkgidx_file)
+                    )
 
-                with pkgidx_file.open("rb") as t:
-                    content = t.read()
-                if len(content) != int(filesize):
-                    logger.error(f"Invalid size of {pkgidx_file}, expected {filesize}, skipped")
-                    pkgidx_file.unlink()
-                    continue
-                if hashlib.sha256(content).hexdigest() != checksum:
-                    logger.error(f"Invalid checksum of {pkgidx_file}, expected {checksum}, skipped")
+                # Currently only support SHA-256 checksum, because
+                # "Clients may not use the MD5Sum and SHA1 fields for security purposes, and must require a SHA256 or a SHA512 field."
+                # from https://wiki.debian.org/DebianRepository/Format#A.22Release.22_files
+                if line.startswith("SHA256:"):
+                    cnt_start = True
+
+        def fetch_pkgidx(entry: Tuple[str, int, str, Path]) -> int:
+            checksum, filesize, filename, pkgidx_file = entry
+            pkglist_url = f"{base_url}/dists/{dist}/{filename}"
+            digest_key = f"dists/{dist}/{filename}"
+            local_file = dist_dir / filename
+            by_hash_file = local_file.parent / "by-hash" / "SHA256" / checksum
+            if index_file_present(digest_key, local_file, filesize, checksum):
+                logger.info(f"Reusing {local_file}")
+                link_or_copy(local_file, pkgidx_file)
+            elif by_hash_file.is_file() and by_hash_file.stat().st_size == filesize:
+                logger.info(f"Reusing {by_hash_file}")
+                link_or_copy(by_hash_file, pkgidx_file)
+            elif (
+                f"{filename}.diff/Index" in diff_indexes
+                and local_file.is_file()
+                and apt_pdiff_update(
+                    f"{base_url}/dists/{dist}/{filename}.diff",
+                    diff_indexes[f"{filename}.diff/Index"],
+                    local_file,
+                    pkgidx_file,
+                    filesize,
+                    checksum,
+                    stats,
+                )
+            ):
+                validators.set_digest(digest_key, pkgidx_file, checksum)
+            else:
+                # size and checksum are verified while downloading
+                sha = hashlib.sha256()
+                ret = check_and_download(
+                    pkglist_url,
+                    pkgidx_file,
+                    size=filesize,
+                    sha=sha,
+                    local_file=local_file,
+                    stats=stats,
+                )
+                if ret != 0:
+                    logger.error(f"Failed to download: {pkglist_url}")
+                    return ret
+                if sha.hexdigest() != checksum:
+                    logger.error(
+                        f"Invalid checksum of {pkgidx_file}, expected {checksum}, skipped"
+                    )
                     pkgidx_file.unlink()
-                    continue
-                if pkgidx_content is None and pkgidx_file.stem == "Packages":
-                    logger.info(f"getting packages index content from {pkgidx_file.name}")
-                    suffix = pkgidx_file.suffix
-                    if suffix == ".xz":
-                        pkgidx_content = lzma.decompress(content).decode("utf-8")
-                    elif suffix == ".bz2":
-                        pkgidx_content = bz2.decompress(content).decode("utf-8")
-                    elif suffix == ".gz":
-                        pkgidx_content = gzip.decompress(content).decode("utf-8")
-                    elif suffix == "":
-                        pkgidx_content = content.decode("utf-8")
-                    else:
-                        logger.error("unsupported format")
-
-            # Currently only support SHA-256 checksum, because
-            # "Clients may not use the MD5Sum and SHA1 fields for security purposes, and must require a SHA256 or a SHA512 field."
-            # from https://wiki.debian.org/DebianRepository/Format#A.22Release.22_files
-            if line.startswith("SHA256:"):
-                cnt_start = True
-    if not cnt_start:
-        logger.error("Cannot find SHA-256 checksum")
-        return 1
+                    return 2
+                validators.set_digest(digest_key, pkgidx_file, checksum)
+            if acquire_by_hash and "by-hash" not in Path(filename).parts:
+                # published together with the index file, before the new InRelease
+                tmp_by_hash_dir = pkgidx_file.parent / "by-hash" / "SHA256"
+                tmp_by_hash_dir.mkdir(parents=True, exist_ok=True)
+                link_or_copy(pkgidx_file, tmp_by_hash_dir / checksum)
+            return 0
 
-    def collect_tmp_dir():
-        try:
-            move_files_in(pkgidx_tmp_dir, pkgidx_dir)
-            move_files_in(comp_tmp_dir, comp_dir)
-            move_files_in(dist_tmp_dir, dist_dir)
+        def is_diff_index(entry: Tuple[str, int, str, Path]) -> bool:
+            return entry[2].endswith(".diff/Index")
+
+        # PDiff indexes go first, so that uncompressed index files can be patched
+        results: Dict[str, int] = {}
+        diff_indexes: Dict[str, Path] = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for entries in (
+                [e for e in pkgidx_files if is_diff_index(e)],
+                [e for e in pkgidx_files if not is_diff_index(e)],
+            ):
+                for entry, ret in zip(entries, executor.map(fetch_pkgidx, entries)):
+                    results[entry[2]] = ret
+                    if ret == 0 and is_diff_index(entry):
+                        diff_indexes[entry[2]] = entry[3]
+
+        # Release also lists variants upstream may not serve (e.g. the uncompressed
+        # Packages of dak), which is fine if another variant of the same index is
+        # there; an index with none, or a variant with wrong content, is an error
+        missing_indexes = set()
+        present_indexes = set()
+        for _, _, filename, _ in pkgidx_files:
+            fn = Path(filename)
+            index = str(fn.with_suffix("") if fn.suffix in PKGIDX_OPENERS else fn)
+            if results[filename] == 0:
+                present_indexes.add(index)
+            elif results[filename] == 1:
+                missing_indexes.add(index)
+            else:
+                idx_err = 1
+        if len(missing_indexes - present_indexes) > 0:
+            idx_err = 1
+
+        pkgidx_source = None
+        for checksum, _, filename, pkgidx_file in pkgidx_files:
+            if results[filename] != 0:
+                continue
+            if acquire_by_hash and "by-hash" not in Path(filename).parts:
+                by_hash_dirs.add((dist_dir / filename).parent / "by-hash" / "SHA256")
+            # the first Packages variant listed in Release feeds the package list
+            if pkgidx_source is None and pkgidx_file.stem == "Packages":
+                if pkgidx_file.suffix in PKGIDX_OPENERS:
+                    logger.info(
+                        f"getting packages index content from {pkgidx_file.name}"
+                    )
+                    pkgidx_source = pkgidx_file
+                else:
+                    logger.error("unsupported format")
+
+        def collect_tmp_dir():
+            if plan is not None:
+                # nothing is published when planning
+                discard_tmp_dir()
+                return 0
+            try:
+                if publisher is not None:
+                    # published later by publisher.publish(), together with other jobs
+                    target_dir = publisher.stage(dist)
+                    (target_dir / repo / arch_dir).mkdir(parents=True, exist_ok=True)
+                    move_files_in(pkgidx_tmp_dir, target_dir / repo / arch_dir)
+                    move_files_in(comp_tmp_dir, target_dir / repo)
+                    move_files_in(dist_tmp_dir, target_dir)
+                else:
+                    move_files_in(pkgidx_tmp_dir, pkgidx_dir)
+                    move_files_in(comp_tmp_dir, comp_dir)
+                    move_files_in(dist_tmp_dir, dist_dir)
 
-            pkgidx_tmp_dir.rmdir()
-            comp_tmp_dir.rmdir()
-            dist_tmp_dir.rmdir()
+                pkgidx_tmp_dir.rmdir()
+                comp_tmp_dir.rmdir()
+                dist_tmp_dir.rmdir()
+                if publisher is None:
+                    for by_hash_dir in by_hash_dirs:
+                        prune_by_hash(by_hash_dir)
+                return 0
+            except:
+                traceback.print_exc()
+                return 1
+
+        def discard_tmp_dir():
+            for tmp_dir in (pkgidx_tmp_dir, comp_tmp_dir, dist_tmp_dir):
+                shutil.rmtree(str(tmp_dir), ignore_errors=True)
+
+        if not cnt_start:
+            logger.error("Cannot find SHA-256 checksum")
+            discard_tmp_dir()
+            return 1
+
+        if arch in ARCH_NO_PKGIDX:
+            stats.index_seconds = time.time() - start
+            if collect_tmp_dir() == 1:
+                return 1
+            if idx_err == 0:
+                validators.mark_done(job_key, release_checksum)
+            logger.info(f"Mirroring {base_url} {dist}, {repo}, {arch} done!")
             return 0
-        except:
-            traceback.print_exc()
+
+        if pkgidx_source is None:
+            logger.error("index is empty, failed")
+            discard_tmp_dir()
+            if len(list(pkgidx_dir.glob("Packages*"))) == 0:
+                logger.warning(
+                    f"{pkgidx_dir/'Packages'} never existed, upstream may not provide {dist}/{repo}/{arch}, ignore this error"
+                )
+                return 0
             return 1
 
-    if arch in ARCH_NO_PKGIDX:
+        # Download packages
+        err = 0
+        deb_count = 0
+        deb_size = 0
+        stats.index_seconds = time.time() - start
+        start = time.time()
+
+        def collect_results(futures) -> int:
+            ret = 0
+            for future in futures:
+                try:
+                    if future.result() != 0:
+                        ret = 1
+                except:
+                    traceback.print_exc()
+                    ret = 1
+            return ret
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers
+        ) as executor, PKGIDX_OPENERS[pkgidx_source.suffix](pkgidx_source, "rb") as fd:
+            pending = set()
+            batch: List[Tuple[str, int, str]] = []
+
+            def submit_batch() -> int:
+                # look up the state of a whole batch of packages at once
+                nonlocal pending
+                ret = 0
+                states = state_db.lookup([b[0] for b in batch]) if state_db else {}
+                for pkg_filename, pkg_size, pkg_checksum in batch:
+                    state = states.get(pkg_filename)
+                    # trusted without a stat(), so files removed behind our back
+                    # are only restored by --full or --verify
+                    if (
+                        not full
+                        and not verify
+                        and state is not None
+                        and state[0] == pkg_size
+                        and state[3] == pkg_checksum
+                    ):
+                        if pool_index is not None:
+                            pool_index.add(pkg_filename, pkg_checksum)
+                        continue
+                    if plan is not None:
+                        try:
+                            st = (dest_base_dir / pkg_filename).stat()
+                            present = st.st_size == pkg_size
+                        except FileNotFoundError:
+                            present = False
+                        if not present:
+                            plan.add_fetch(pkg_filename, pkg_size)
+                        continue
+                    pending.add(
+                        executor.submit(
+                            apt_download_package,
+                            base_url,
+                            pkg_filename,
+                            pkg_size,
+                            pkg_checksum,
+                            dest_base_dir,
+                            pool_index,
+                            state_db,
+                            state,
+                            verify,
+                            stats,
+                        )
+                    )
+                    # keep the number of queued packages bounded
+                    if len(pending) >= workers * 4:
+                        done, pending = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED
+                        )
+                        if collect_results(done) != 0:
+                            ret = 1
+                batch.clear()
+                return ret
+
+            for pkg in parse_pkgidx(fd):
+                if pkg is None:
+                    logger.error("Failed to parse one package description")
+                    err = 1
+                    continue
+                pkg_filename, pkg_size, pkg_checksum = pkg
+                deb_count += 1
+                deb_size += pkg_size
+
+                dest_filename = dest_base_dir / pkg_filename
+                if dest_filename.suffix == ".deb":
+                    deb_set[str(dest_filename.relative_to(dest_base_dir))] = pkg_size
+                if unchanged and not verify:
+                    continue
+                if pool_index is not None and pool_index.is_verified(
+                    pkg_filename, pkg_checksum
+                ):
+                    continue
+
+                batch.append(pkg)
+                if len(batch) >= PackageStateDB.BATCH_SIZE and submit_batch() != 0:
+                    err = 1
+            if submit_batch() != 0:
+                err = 1
+            if collect_results(concurrent.futures.as_completed(pending)) != 0:
+                err = 1
+        if state_db is not None:
+            state_db.flush()
+        stats.package_seconds = time.time() - start
+        stats.packages = deb_count
+
         if collect_tmp_dir() == 1:
             return 1
+        if err == 0 and idx_err == 0:
+            validators.mark_done(job_key, release_checksum)
         logger.info(f"Mirroring {base_url} {dist}, {repo}, {arch} done!")
-        return 0
-
-    if pkgidx_content is None:
-        logger.error("index is empty, failed")
-        if len(list(pkgidx_dir.glob("Packages*"))) == 0:
-            logger.warning(
-                f"{pkgidx_dir/'Packages'} never existed, upstream may not provide {dist}/{repo}/{arch}, ignore this error"
-            )
-            return 0
-        return 1
+        logger.info(f"{deb_count} packages, {deb_size} bytes in total")
+        return err
 
-    # Download packages
-    err = 0
-    deb_count = 0
-    deb_size = 0
-    for pkg in pkgidx_content.split("\n\n"):
-        if len(pkg) < 10:  # ignore blanks
-            continue
-        try:
-            pkg_filename = pattern_package_name.search(pkg).group(1)
-            pkg_size = int(pattern_package_size.search(pkg).group(1))
-            pkg_checksum = pattern_package_sha256.search(pkg).group(1)
-        except:
-            logger.error("Failed to parse one package description")
-            traceback.print_exc()
-            err = 1
-            continue
-        deb_count += 1
-        deb_size += pkg_size
-
-        dest_filename = dest_base_dir / pkg_filename
-        dest_dir = dest_filename.parent
-        if not dest_dir.is_dir():
-            dest_dir.mkdir(parents=True, exist_ok=True)
-        if dest_filename.suffix == ".deb":
-            deb_set[str(dest_filename.relative_to(dest_base_dir))] = pkg_size
-        if dest_filename.is_file() and dest_filename.stat().st_size == pkg_size:
-            logger.info(f"Skipping {pkg_filename}, size {pkg_size}")
-            continue
 
-        pkg_url = f"{base_url}/{pkg_filename}"
-        dest_tmp_filename = dest_filename.with_name("._syncing_." + dest_filename.name)
-        for retry in range(MAX_RETRY):
-            logger.info(f"downloading {pkg_url} to {dest_filename}")
-            # break # dry run
-            if check_and_download(pkg_url, dest_tmp_filename) != 0:
-                continue
+def scan_debs(path: str, rel: str) -> Iterator[str]:
+    """
+    Recursively yield the paths (relative to the mirror root) of .deb files under
+    `path`, relying on dirent types instead of stat'ing every file.
+    """
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan_debs(entry.path, rel + entry.name + "/")
+            elif entry.name.endswith(".deb") and entry.is_file():
+                yield rel + entry.name
 
-            sha = hashlib.sha256()
-            with dest_tmp_filename.open("rb") as f:
-                for block in iter(lambda: f.read(1024**2), b""):
-                    sha.update(block)
-            if sha.hexdigest() != pkg_checksum:
-                logger.error(f"Invalid checksum of {dest_filename}, expected {pkg_checksum}")
-                dest_tmp_filename.unlink()
-                continue
-            dest_tmp_filename.rename(dest_filename)
-            break
-        else:
-            logger.error(f"Failed to download {dest_filename}")
-            err = 1
 
-    if collect_tmp_dir() == 1:
-        return 1
-    logger.info(f"Mirroring {base_url} {dist}, {repo}, {arch} done!")
-    logger.info(f"{deb_count} packages, {deb_size} bytes in total")
-    return err
+def apt_delete_old_debs(
+    dest_base_dir: Path,
+    remote_set: Dict[str, int],
+    dry_run: bool,
+    workers: int = 1,
+    state_db: Optional[PackageStateDB] = None,
+    plan: Optional[SyncPlan] = None,
+):
+    # packages live in pool/ (or, rarely, in other top-level directories
+    # referenced by the index), so there is no need to walk dists/
+    roots = {"pool"} | {k.split("/", 1)[0] for k in remote_set if "/" in k}
 
+    def delete_unreferenced(paths: Iterator[str]) -> int:
+        count = 0
+        for i in paths:
+            if i in remote_set:
+                continue
+            count += 1
+            if plan is not None:
+                plan.add_delete(i, os.path.getsize(os.path.join(dest_base_dir, i)))
+            elif dry_run:
+                logger.info(f"Will delete {i}")
+            else:
+                logger.info(f"Deleting {i}")
+                os.unlink(os.path.join(dest_base_dir, i))
+                if state_db is not None:
+                    state_db.forget(i)
+        return count
 
-def apt_delete_old_debs(dest_base_dir: Path, remote_set: Dict[str, int], dry_run: bool):
-    on_disk = set(
-        [str(i.relative_to(dest_base_dir)) for i in dest_base_dir.glob("**/*.deb")]
+    # .deb files directly in the mirror root
+    count = delete_unreferenced(
+        e.name
+        for e in os.scandir(dest_base_dir)
+        if e.name.endswith(".deb") and e.is_file()
     )
-    deleting = on_disk - remote_set.keys()
-    # print(on_disk)
-    # print(remote_set)
-    logger.info(f"Deleting {len(deleting)} packages not in the index{' (dry run)' if dry_run else ''}")
-    for i in deleting:
-        if dry_run:
-            logger.info(f"Will delete {i}")
-        else:
-            logger.info(f"Deleting {i}")
-            (dest_base_dir / i).unlink()
+    # with several workers, every second-level directory (e.g. pool/main/a) is
+    # scanned by its own task
+    subdirs = []
+    for root in sorted(roots):
+        root_dir = dest_base_dir / root
+        if not root_dir.is_dir() or root_dir.is_symlink():
+            continue
+        if workers <= 1:
+            count += delete_unreferenced(scan_debs(str(root_dir), root + "/"))
+            continue
+        for entry in os.scandir(root_dir):
+            rel = f"{root}/{entry.name}"
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append((entry.path, rel + "/"))
+            elif entry.name.endswith(".deb") and entry.is_file():
+                count += delete_unreferenced(iter([rel]))
+    if len(subdirs) > 0:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(delete_unreferenced, scan_debs(path, rel))
+                for path, rel in subdirs
+            ]
+            for future in futures:
+                count += future.result()
+    logger.info(f"{'Would delete' if dry_run else 'Deleted'} {count} packages not in the index")
 
 
 def main():
@@ -383,6 +1875,40 @@ def main():
         action="store_true",
         help="print package files to be deleted only",
     )
+    parser.add_argument(
+        "--workers", default=1, type=int, help="number of concurrent downloading jobs"
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="check all index and package files even if Release is unchanged",
+    )
+    parser.add_argument(
+        "--state-db",
+        type=Path,
+        help="sqlite database remembering the size, mtime, inode and SHA256 of pool files; files recorded there are only checked again with --full or --verify",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="check SHA256 of all package files, skipping those unchanged since they were last verified (see --state-db)",
+    )
+    parser.add_argument(
+        "--jobs",
+        default=1,
+        type=int,
+        help="number of dist/component/arch triples mirrored at the same time",
+    )
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        help="publish each dists/<dist> at once by switching a symlink, after all of its jobs succeeded",
+    )
+    parser.add_argument(
+        "--plan",
+        metavar="PATH",
+        help="fetch metadata only and write the package files to fetch and delete as JSON to PATH ('-' for stdout), without downloading packages or publishing anything",
+    )
     args = parser.parse_args()
 
     # generate lists of os codenames
@@ -414,24 +1940,102 @@ def main():
     logger.info(f"Configuration: {os_list=}, {component_lists=}, {arch_lists=}")
 
     args.working_dir.mkdir(parents=True, exist_ok=True)
+    global content_store
+    if content_store is not None and not content_store.usable_for(args.working_dir):
+        content_store = None
     failed = []
     deb_set = {}
+    pool_index = PoolIndex()
+    validators.load(args.working_dir / ".apt-sync-validators.json")
+    # each job downloads index files or packages with up to `workers` threads
+    setup_session(args.workers * args.jobs + args.jobs)
+    state_db = PackageStateDB(args.state_db) if args.state_db else None
+    publisher = (
+        SnapshotPublisher(args.working_dir) if args.snapshot and not args.plan else None
+    )
+    plan = SyncPlan() if args.plan else None
 
+    jobs = []
     for os, arch_list, comp_list in zip(os_list, arch_lists, component_lists):
         for comp in comp_list:
             for arch in arch_list:
-                if (
-                    apt_mirror(
-                        args.base_url, os, comp, arch, args.working_dir, deb_set=deb_set
-                    )
-                    != 0
-                ):
-                    failed.append((os, comp, arch))
+                jobs.append((os, comp, arch))
+
+    all_stats = {job: JobStats() for job in jobs}
+
+    def run_job(job: Tuple[str, str, str]) -> int:
+        os, comp, arch = job
+        try:
+            ret = apt_mirror(
+                args.base_url,
+                os,
+                comp,
+                arch,
+                args.working_dir,
+                deb_set=deb_set,
+                workers=args.workers,
+                pool_index=pool_index,
+                full=args.full,
+                state_db=state_db,
+                verify=args.verify,
+                stats=all_stats[job],
+                publisher=publisher,
+                plan=plan,
+            )
+            all_stats[job].success = ret == 0
+            return ret
+        except:
+            traceback.print_exc()
+            return 1
+
+    # results are collected in the original order, so that `failed` stays stable
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for job, ret in zip(jobs, executor.map(run_job, jobs)):
+            if ret != 0:
+                failed.append(job)
+    if publisher is not None:
+        for dist in dict.fromkeys(job[0] for job in jobs):
+            if any(job[0] == dist for job in failed):
+                publisher.discard(dist)
+            elif publisher.publish(dist) != 0:
+                failed.append((dist, "*", "*"))
+    if plan is not None:
+        if len(failed) == 0:
+            apt_delete_old_debs(
+                args.working_dir, deb_set, True, workers=args.workers, plan=plan
+            )
+        else:
+            logger.error(f"Failed APT repos of {args.base_url}: {failed}")
+        plan.write(args.plan, args.base_url, all_stats, failed)
+        if state_db is not None:
+            state_db.close()
+        return
+    validators.save()
+    n_requests, n_connections = connection_stats()
+    logger.info(f"{n_requests} HTTP requests sent over {n_connections} connections")
+    if len(METRICS_FILE) > 0:
+        write_metrics(
+            METRICS_FILE, args.base_url, all_stats, (n_requests, n_connections)
+        )
+    logger.info(
+        f"{pool_index.duplicates} duplicate package references skipped, "
+        f"{len(pool_index.verified)} unique pool files verified"
+    )
     if len(failed) > 0:
         logger.error(f"Failed APT repos of {args.base_url}: {failed}")
+        if state_db is not None:
+            state_db.close()
         return
     if args.delete or args.delete_dry_run:
-        apt_delete_old_debs(args.working_dir, deb_set, args.delete_dry_run)
+        apt_delete_old_debs(
+            args.working_dir,
+            deb_set,
+            args.delete_dry_run,
+            workers=args.workers,
+            state_db=state_db,
+        )
+    if state_db is not None:
+        state_db.close()
 
     if len(REPO_SIZE_FILE) > 0:
         with open(REPO_SIZE_FILE, "a") as fd:
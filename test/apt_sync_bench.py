@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of apt-sync.py against a synthetic Debian repository
+served from localhost, so that performance changes can be measured without
+network access.
+
+The repository has a Release (and InRelease) file, and Packages / Packages.xz
+with N stanzas for each dist and arch. The server supports ETag, If-None-Match,
+Range and If-Range, and can add latency to every request. A fraction of
+package responses can be cut off midway, which apt-sync resumes, or answered
+with 503, which the session retries.
+
+Each benchmark runs apt_mirror() for every dist and arch on a cold (empty)
+tree, then again on the warm tree, and once more with --full.
+
+e.g. ./test/apt_sync_bench.py --packages 5000 --size 16384 --latency 5 --workers 8
+"""
+import argparse
+import hashlib
+import http.server
+import importlib.util
+import logging
+import lzma
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+_here = Path(__file__).resolve().parent
+
+
+def load_apt_sync():
+    spec = importlib.util.spec_from_file_location(
+        "apt_sync", _here.parent / "apt-sync.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate_repo(root: Path, dists, arches, n_packages: int, size: int, seed: int):
+    rng = random.Random(seed)
+    for arch in arches:
+        stanzas = []
+        for i in range(n_packages):
+            name = f"pkg{i}"
+            filename = f"pool/main/{name[:4]}/{name}/{name}_1.0_{arch}.deb"
+            path = root / filename
+            path.parent.mkdir(parents=True, exist_ok=True)
+            data = rng.randbytes(size)
+            path.write_bytes(data)
+            stanzas.append(
+                f"Package: {name}\n"
+                f"Version: 1.0\n"
+                f"Architecture: {arch}\n"
+                f"Filename: {filename}\n"
+                f"Size: {len(data)}\n"
+                f"SHA256: {hashlib.sha256(data).hexdigest()}\n"
+                f"Description: synthetic package {i}\n"
+                f" generated by apt_sync_bench.py\n"
+            )
+        packages = "\n".join(stanzas).encode()
+        for dist in dists:
+            pkgidx_dir = root / "dists" / dist / "main" / f"binary-{arch}"
+            pkgidx_dir.mkdir(parents=True, exist_ok=True)
+            (pkgidx_dir / "Packages").write_bytes(packages)
+            (pkgidx_dir / "Packages.xz").write_bytes(lzma.compress(packages))
+
+    for dist in dists:
+        dist_dir = root / "dists" / dist
+        release = (
+            f"Origin: apt-sync-bench\n"
+            f"Suite: {dist}\n"
+            f"Codename: {dist}\n"
+            f"Architectures: {' '.join(arches)}\n"
+            f"Components: main\n"
+            f"Acquire-By-Hash: yes\n"
+            f"SHA256:\n"
+        )
+        for arch in arches:
+            for name in ("Packages", "Packages.xz"):
+                rel = f"main/binary-{arch}/{name}"
+                content = (dist_dir / rel).read_bytes()
+                release += f" {hashlib.sha256(content).hexdigest()} {len(content)} {rel}\n"
+        (dist_dir / "Release").write_text(release)
+        (dist_dir / "InRelease").write_text(release)
+        (dist_dir / "Release.gpg").write_text("not a signature\n")
+
+
+class RepoHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    root: Path
+    latency = 0.0
+    error_rate = 0.0
+    http_error_rate = 0.0
+    rng = random.Random(0)
+    lock = threading.Lock()
+    requests = 0
+    errors = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with self.lock:
+            RepoHandler.requests += 1
+            is_deb = self.path.endswith(".deb")
+            cut = is_deb and self.rng.random() < self.error_rate
+            fail = is_deb and not cut and self.rng.random() < self.http_error_rate
+            if cut or fail:
+                RepoHandler.errors += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        path = self.root / self.path.lstrip("/")
+        if ".." in self.path or not path.is_file():
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if fail:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        st = path.stat()
+        etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        data = path.read_bytes()
+        start = 0
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes=") and self.headers.get("If-Range") == etag:
+            start = int(range_header[6:].split("-")[0])
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header(
+            "Last-Modified", self.date_time_string(int(st.st_mtime))
+        )
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        if cut:
+            self.wfile.write(data[start : start + (len(data) - start) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+
+def run_sync(apt_sync, base_url: str, dest: Path, args, full: bool) -> dict:
+    # every real run is a new process, so start from fresh module state
+    apt_sync.metadata_cache = apt_sync.MetadataCache(apt_sync.METADATA_CACHE_SIZE)
+    apt_sync.validators = apt_sync.ValidatorStore()
+    apt_sync.validators.load(dest / ".apt-sync-validators.json")
+    apt_sync.setup_session(args.workers + 1)
+    pool_index = apt_sync.PoolIndex()
+    deb_set = {}
+    failed = 0
+    all_stats = []
+    start = time.time()
+    for dist in args.dists.split(","):
+        for arch in args.arches.split(","):
+            stats = apt_sync.JobStats()
+            all_stats.append(stats)
+            if (
+                apt_sync.apt_mirror(
+                    base_url,
+                    dist,
+                    "main",
+                    arch,
+                    dest,
+                    deb_set=deb_set,
+                    workers=args.workers,
+                    pool_index=pool_index,
+                    full=full,
+                    stats=stats,
+                )
+                != 0
+            ):
+                failed += 1
+    apt_sync.validators.save()
+    elapsed = time.time() - start
+    n_requests, n_connections = apt_sync.connection_stats()
+    return {
+        "connections": n_connections,
+        "seconds": elapsed,
+        "failed": failed,
+        "packages": len(deb_set),
+        "fetched": sum(s.fetched for s in all_stats),
+        "bytes": sum(s.downloaded_bytes for s in all_stats),
+        "retries": sum(s.retries for s in all_stats),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--packages", type=int, default=1000, help="stanzas per arch")
+    parser.add_argument("--size", type=int, default=4096, help="bytes per package")
+    parser.add_argument("--dists", default="stable", help="e.g. stable,testing")
+    parser.add_argument("--arches", default="amd64", help="e.g. amd64,arm64")
+    parser.add_argument("--latency", type=float, default=0, help="ms per request")
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0,
+        help="fraction of .deb responses cut off midway",
+    )
+    parser.add_argument(
+        "--http-error-rate",
+        type=float,
+        default=0,
+        help="fraction of .deb requests answered with 503",
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="keep the temporary trees")
+    parser.add_argument("--verbose", action="store_true", help="show apt-sync logs")
+    args = parser.parse_args()
+
+    apt_sync = load_apt_sync()
+    if not args.verbose:
+        apt_sync.logger.setLevel(logging.CRITICAL)
+
+    workdir = Path(tempfile.mkdtemp(prefix="apt-sync-bench."))
+    upstream = workdir / "upstream"
+    mirror = workdir / "mirror"
+    mirror.mkdir(parents=True)
+    print(f"Generating {args.packages} packages x {args.size} bytes in {upstream}")
+    generate_repo(
+        upstream,
+        args.dists.split(","),
+        args.arches.split(","),
+        args.packages,
+        args.size,
+        args.seed,
+    )
+
+    RepoHandler.root = upstream
+    RepoHandler.latency = args.latency / 1000
+    RepoHandler.error_rate = args.error_rate
+    RepoHandler.http_error_rate = args.http_error_rate
+    RepoHandler.rng = random.Random(args.seed)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RepoHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    ret = 0
+    try:
+        for name, full in (("cold", True), ("warm", False), ("warm --full", True)):
+            RepoHandler.requests = RepoHandler.errors = 0
+            result = run_sync(apt_sync, base_url, mirror, args, full)
+            rate = result["packages"] / result["seconds"]
+            throughput = result["bytes"] / result["seconds"] / 1024**2
+            print(
+                f"{name:>12}: {result['seconds']:8.3f} s, "
+                f"{result['packages']} packages ({rate:.1f}/s), "
+                f"{result['fetched']} fetched, {result['bytes']} bytes ({throughput:.2f} MiB/s), "
+                f"{RepoHandler.requests} requests over {result['connections']} connections, "
+                f"{RepoHandler.errors} injected errors, "
+                f"{result['retries']} retries, {result['failed']} failed jobs"
+            )
+            if result["failed"] > 0:
+                ret = 1
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f"Trees kept in {workdir}")
+        else:
+            shutil.rmtree(workdir)
+    sys.exit(ret)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,33 @@
 #!/usr/bin/env python3
 import argparse
 import bz2
+import concurrent.futures
 import gzip
+import hashlib
+import json
 import logging
+import lzma
 import os
 import re
 import shutil
 import sqlite3
 import subprocess as sp
 import tempfile
+import threading
 import time
 import traceback
 import xml.etree.ElementTree as ET
 from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import Dict, List
+from typing import IO, Dict, Iterator, List, Optional, Set, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -30,8 +41,40 @@ logger.addHandler(handler)
 
 REPO_SIZE_FILE = os.getenv("REPO_SIZE_FILE", "")
 DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "1800"))
+MAX_RETRY = int(os.getenv("MAX_RETRY", "3"))
+# deadline in seconds for probing all candidate repositories
+PROBE_TIMEOUT = int(os.getenv("PROBE_TIMEOUT", "60"))
+PROBE_WORKERS = 16
 REPO_STAT = {}
 
+REPO_NS = "{http://linux.duke.edu/metadata/repo}"
+COMMON_NS = "{http://linux.duke.edu/metadata/common}"
+XML_BASE = "{http://www.w3.org/XML/1998/namespace}base"
+METADATA_OPENERS = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+    ".xz": lzma.open,
+    ".xml": open,
+    ".sqlite": open,
+}
+if zstandard is not None:
+    METADATA_OPENERS[".zst"] = zstandard.open
+# formats of primary metadata by the cost of reading the package sizes
+PRIMARY_PREFERENCE = [
+    ".sqlite",
+    ".xml",
+    ".xml.gz",
+    ".xml.zst",
+    ".xml.xz",
+    ".sqlite.gz",
+    ".sqlite.zst",
+    ".sqlite.xz",
+    ".xml.bz2",
+    ".sqlite.bz2",
+]
+if zstandard is None:
+    PRIMARY_PREFERENCE = [k for k in PRIMARY_PREFERENCE if not k.endswith(".zst")]
+
 
 OS_TEMPLATE = {
     "rhel-current": ["9", "10"],
@@ -40,6 +83,9 @@ OS_TEMPLATE = {
 
 pattern_os_template = re.compile(r"@\{(.+)\}")
 
+# shared by all threads, keeping connections to the upstream alive
+session = requests.Session()
+
 def replace_os_template(os_list: List[str]) -> List[str]:
     ret = []
     for i in os_list:
@@ -53,64 +99,17 @@ def replace_os_template(os_list: List[str]) -> List[str]:
             ret.append(i)
     return ret
 
-def calc_repo_size(path: Path):
-    dbfiles = path.glob("repodata/*primary.*")
-    with tempfile.NamedTemporaryFile() as tmp:
-        dec = None
-        dbfile = None
-        for db in dbfiles:
-            dbfile = db
-            suffixes = db.suffixes
-            if suffixes[-1] == ".bz2":
-                dec = bz2.decompress
-                suffixes = suffixes[:-1]
-            elif suffixes[-1] == ".gz":
-                dec = gzip.decompress
-                suffixes = suffixes[:-1]
-            elif suffixes[-1] in (".sqlite", ".xml"):
-                dec = lambda x: x
-        if dec is None:
-            logger.error(f"Failed to read from {path}: {list(dbfiles)}")
-            return
-        with db.open("rb") as f:
-            tmp.write(dec(f.read()))
-            tmp.flush()
-
-        if suffixes[-1] == ".sqlite":
-            conn = sqlite3.connect(tmp.name)
-            c = conn.cursor()
-            c.execute("select sum(size_package),count(1) from packages")
-            size, cnt = c.fetchone()
-            conn.close()
-        elif suffixes[-1] == ".xml":
-            try:
-                tree = ET.parse(tmp.name)
-                root = tree.getroot()
-                assert root.tag.endswith("metadata")
-                cnt, size = 0, 0
-                for location in root.findall(
-                    "./{http://linux.duke.edu/metadata/common}package/{http://linux.duke.edu/metadata/common}size"
-                ):
-                    size += int(location.attrib["package"])
-                    cnt += 1
-            except:
-                traceback.print_exc()
-                return
-        else:
-            logger.error(f"Unknown suffix {suffixes}")
-            return
-
-        logger.info(f"Repository {path}:")
-        logger.info(f"  {cnt} packages, {size} bytes in total")
-
-        global REPO_STAT
-        REPO_STAT[str(path)] = (size, cnt) if cnt > 0 else (0, 0)  # size can be None
-
-
-def check_and_download(url: str, dst_file: Path) -> int:
+def check_and_download(
+    url: str, dst_file: Path, size: Optional[int] = None, sha=None
+) -> int:
+    """
+    If `size` is given, the download is aborted as soon as more bytes than
+    expected arrive. If a hashlib object is given as `sha`, it is updated with
+    every chunk written.
+    """
     try:
         start = time.time()
-        with requests.get(url, stream=True, timeout=(30, 60)) as r:
+        with session.get(url, stream=True, timeout=(30, 60)) as r:
             r.raise_for_status()
             if "last-modified" in r.headers:
                 remote_ts = parsedate_to_datetime(
@@ -119,6 +118,7 @@ def check_and_download(url: str, dst_file: Path) -> int:
             else:
                 remote_ts = None
 
+            received = 0
             with dst_file.open("wb") as f:
                 for chunk in r.iter_content(chunk_size=1024**2):
                     if time.time() - start > DOWNLOAD_TIMEOUT:
@@ -126,7 +126,14 @@ def check_and_download(url: str, dst_file: Path) -> int:
                     if not chunk:
                         continue  # filter out keep-alive new chunks
 
+                    received += len(chunk)
+                    if size is not None and received > size:
+                        raise ValueError(f"Size exceeded, expected {size}")
                     f.write(chunk)
+                    if sha is not None:
+                        sha.update(chunk)
+            if size is not None and received != size:
+                raise ValueError(f"Invalid size {received}, expected {size}")
             if remote_ts is not None:
                 os.utime(dst_file, (remote_ts, remote_ts))
         return 0
@@ -137,6 +144,253 @@ def check_and_download(url: str, dst_file: Path) -> int:
     return 1
 
 
+def new_checksum(checksum_type: str):
+    # "sha" is the old name of sha1 in repomd.xml
+    return hashlib.new("sha1" if checksum_type == "sha" else checksum_type)
+
+
+def parse_repomd(path: Path) -> Dict[str, Tuple[str, str, str]]:
+    """
+    Return (href, checksum type, checksum) of every data entry in repomd.xml,
+    keyed by type
+    """
+    root = ET.parse(path).getroot()
+    assert root.tag.endswith("repomd")
+    ret = {}
+    for data in root.findall(f"./{REPO_NS}data"):
+        location = data.find(f"{REPO_NS}location")
+        checksum = data.find(f"{REPO_NS}checksum")
+        if location is None or checksum is None:
+            continue
+        ret[data.attrib["type"]] = (
+            location.attrib["href"],
+            checksum.attrib["type"],
+            checksum.text.strip(),
+        )
+    return ret
+
+
+def iter_primary(
+    fd: IO[bytes],
+) -> Iterator[Tuple[str, Optional[str], int, str, str, str]]:
+    """
+    Yield (href, xml:base, size, checksum type, checksum, arch) of every package
+    in primary.xml, without keeping the parsed tree in memory
+    """
+    root = None
+    for event, elem in ET.iterparse(fd, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            continue
+        if elem.tag != f"{COMMON_NS}package":
+            continue
+        location = elem.find(f"{COMMON_NS}location")
+        checksum = elem.find(f"{COMMON_NS}checksum")
+        yield (
+            location.attrib["href"],
+            location.attrib.get(XML_BASE),
+            int(elem.find(f"{COMMON_NS}size").attrib["package"]),
+            checksum.attrib["type"],
+            checksum.text.strip(),
+            elem.findtext(f"{COMMON_NS}arch", ""),
+        )
+        root.clear()  # drop the packages seen so far
+
+
+def primary_metadata_files(path: Path) -> List[Path]:
+    """
+    Return the primary metadata files of the repository at `path`, cheapest
+    to read first
+    """
+    repomd = path / "repodata" / "repomd.xml"
+    files = []
+    if repomd.is_file():
+        try:
+            entries = parse_repomd(repomd)
+            files = [
+                path / entries[t][0] for t in ("primary_db", "primary") if t in entries
+            ]
+        except:
+            traceback.print_exc()
+    if len(files) == 0:
+        files = list(path.glob("repodata/*primary.*"))
+
+    def kind(file: Path) -> str:
+        return file.suffix if file.suffix in (".xml", ".sqlite") else "".join(file.suffixes[-2:])
+
+    return sorted(
+        (f for f in files if f.is_file() and kind(f) in PRIMARY_PREFERENCE),
+        key=lambda f: PRIMARY_PREFERENCE.index(kind(f)),
+    )
+
+
+def calc_repo_size(path: Path):
+    dbfiles = primary_metadata_files(path)
+    if len(dbfiles) == 0:
+        logger.error(f"Failed to read from {path}: no supported primary metadata")
+        return
+    db = dbfiles[0]
+    opener = METADATA_OPENERS[db.suffix]
+
+    if ".sqlite" in db.suffixes:
+        if db.suffix == ".sqlite":
+            conn = sqlite3.connect(f"{db.absolute().as_uri()}?mode=ro", uri=True)
+            size, cnt = conn.execute(
+                "select sum(size_package),count(1) from packages"
+            ).fetchone()
+            conn.close()
+        else:
+            # sqlite needs a real file, decompressed chunk by chunk
+            with tempfile.NamedTemporaryFile() as tmp:
+                with opener(db, "rb") as f:
+                    shutil.copyfileobj(f, tmp, 1024**2)
+                tmp.flush()
+                conn = sqlite3.connect(tmp.name)
+                size, cnt = conn.execute(
+                    "select sum(size_package),count(1) from packages"
+                ).fetchone()
+                conn.close()
+    else:
+        try:
+            cnt, size = 0, 0
+            with opener(db, "rb") as f:
+                for _, _, pkg_size, _, _, _ in iter_primary(f):
+                    size += pkg_size
+                    cnt += 1
+        except:
+            traceback.print_exc()
+            return
+
+    logger.info(f"Repository {path}:")
+    logger.info(f"  {cnt} packages, {size} bytes in total")
+
+    global REPO_STAT
+    REPO_STAT[str(path)] = (size, cnt) if cnt > 0 else (0, 0)  # size can be None
+
+
+def download_package(
+    url: str, href: str, size: int, checksum_type: str, checksum: str, dest: Path
+) -> int:
+    dest_file = dest / href
+    if dest_file.is_file() and dest_file.stat().st_size == size:
+        return 0
+    dest_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = dest_file.with_name("._syncing_." + dest_file.name)
+    for retry in range(MAX_RETRY):
+        logger.info(f"downloading {url}/{href} to {dest_file}")
+        sha = new_checksum(checksum_type)
+        if check_and_download(f"{url}/{href}", tmp_file, size=size, sha=sha) != 0:
+            continue
+        if sha.hexdigest() != checksum:
+            logger.error(f"Invalid checksum of {dest_file}, expected {checksum}")
+            tmp_file.unlink()
+            continue
+        tmp_file.rename(dest_file)
+        return 0
+    logger.error(f"Failed to download {dest_file}")
+    return 1
+
+
+def native_sync(
+    url: str, dest: Path, arch: Optional[str] = None, workers: int = 1
+) -> int:
+    """
+    Download the packages listed in the primary metadata of the repository at
+    `url` into `dest`, and delete the .rpm files no longer listed, like
+    `dnf reposync --delete` does.
+    """
+    url = url.rstrip("/")
+    with tempfile.TemporaryDirectory(dir=dest, prefix=".native-sync.") as tmp:
+        tmp_dir = Path(tmp)
+        if check_and_download(url + "/repodata/repomd.xml", tmp_dir / "repomd.xml") != 0:
+            logger.error(f"Failed to download the repomd.xml of {url}")
+            return 1
+        try:
+            repomd = parse_repomd(tmp_dir / "repomd.xml")
+            href, checksum_type, checksum = repomd["primary"]
+        except:
+            traceback.print_exc()
+            return 1
+        primary_file = tmp_dir / Path(href).name
+        opener = METADATA_OPENERS.get(primary_file.suffix)
+        if opener is None:
+            logger.error(f"Unsupported format of {href}")
+            return 1
+        sha = new_checksum(checksum_type)
+        if check_and_download(f"{url}/{href}", primary_file, sha=sha) != 0:
+            logger.error(f"Failed to download the {href}")
+            return 1
+        if sha.hexdigest() != checksum:
+            logger.error(f"Invalid checksum of {href}, expected {checksum}")
+            return 1
+
+        def collect_results(futures) -> int:
+            ret = 0
+            for future in futures:
+                try:
+                    if future.result() != 0:
+                        ret = 1
+                except:
+                    traceback.print_exc()
+                    ret = 1
+            return ret
+
+        err = 0
+        referenced: Set[str] = set()
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers
+        ) as executor, opener(primary_file, "rb") as fd:
+            pending = set()
+            try:
+                for href, base, size, checksum_type, checksum, pkg_arch in iter_primary(
+                    fd
+                ):
+                    if arch is not None and pkg_arch != arch:
+                        continue
+                    if href.startswith("/") or ".." in Path(href).parts:
+                        logger.error(f"Invalid location {href}")
+                        err = 1
+                        continue
+                    referenced.add(os.path.normpath(href))
+                    pending.add(
+                        executor.submit(
+                            download_package,
+                            (base or url).rstrip("/"),
+                            href,
+                            size,
+                            checksum_type,
+                            checksum,
+                            dest,
+                        )
+                    )
+                    # keep the number of queued packages bounded
+                    if len(pending) >= workers * 4:
+                        done, pending = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED
+                        )
+                        if collect_results(done) != 0:
+                            err = 1
+            except:
+                traceback.print_exc()
+                err = 1
+            if collect_results(pending) != 0:
+                err = 1
+
+    if err != 0:
+        logger.error(f"Failed to sync {url}, not deleting old packages")
+        return 1
+    logger.info(f"{len(referenced)} packages from {url} synced to {dest}")
+    for root, dirs, files in os.walk(dest):
+        dirs[:] = [d for d in dirs if not d.startswith(".") and d != "repodata"]
+        for file in files:
+            path = os.path.join(root, file)
+            if file.endswith(".rpm") and os.path.relpath(path, dest) not in referenced:
+                logger.info(f"Deleting {path}")
+                os.unlink(path)
+    return 0
+
+
 def download_repodata(url: str, path: Path) -> int:
     path = path / "repodata"
     path.mkdir(exist_ok=True)
@@ -170,6 +424,49 @@ def download_repodata(url: str, path: Path) -> int:
         i.unlink()
 
 
+def repo_fingerprint(path: Path) -> str:
+    """
+    Digest of the name, size and mtime of every package file in the repository
+    """
+    manifest = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if not d.startswith(".") and d != "repodata"]
+        for file in files:
+            if file.startswith("."):
+                continue
+            full = os.path.join(root, file)
+            st = os.stat(full)
+            manifest.append(f"{os.path.relpath(full, path)}\0{st.st_size}\0{st.st_mtime_ns}")
+    manifest.sort()
+    return hashlib.sha256("\n".join(manifest).encode()).hexdigest()
+
+
+def repomd_stamp(path: Path) -> Optional[List[int]]:
+    try:
+        st = (path / "repodata" / "repomd.xml").stat()
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def load_repo_state(path: Path) -> Dict[str, dict]:
+    try:
+        with path.open() as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logger.warning(f"Ignoring invalid {path}")
+        return {}
+
+
+def save_repo_state(path: Path, state: Dict[str, dict]):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("w") as f:
+        json.dump(state, f)
+    tmp_path.rename(path)
+
+
 def check_args(prop: str, lst: List[str]):
     for s in lst:
         if len(s) == 0 or " " in s:
@@ -204,6 +501,23 @@ def main():
         action="store_true",
         help="""pass --arch to reposync to further filter packages by 'arch' field in metadata (NOT recommended, prone to missing packages in some repositories, e.g. mysql)""",
     )
+    parser.add_argument(
+        "--native",
+        action="store_true",
+        help="download packages listed in primary.xml directly instead of running dnf reposync",
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="number of concurrent downloading jobs (with --native)",
+    )
+    parser.add_argument(
+        "--jobs",
+        default=1,
+        type=int,
+        help="number of arches synced, and of directories indexed by createrepo_c, at the same time",
+    )
     args = parser.parse_args()
 
     raw_os_list = args.os_version.split(",")
@@ -226,11 +540,29 @@ def main():
 
     logger.info(f"Configuration: {os_list=}, {component_list=}, {arch_list=}")
 
+    adapter = HTTPAdapter(pool_maxsize=max(PROBE_WORKERS, args.workers * args.jobs))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
     failed = []
     args.working_dir.mkdir(parents=True, exist_ok=True)
     cache_dir = tempfile.mkdtemp()
-
-    def combination_os_comp(arch: str):
+    # package fingerprint, repomd.xml stamp and size of every repo after the last run
+    state_file = args.working_dir / ".yum-sync-state.json"
+    repo_state = load_repo_state(state_file)
+
+    def probe(probe_url: str) -> bool:
+        try:
+            r = session.head(probe_url, timeout=(10, 30))
+            if r.status_code < 400 or r.status_code == 403:
+                return True
+            logger.warning(f"{probe_url} -> {r.status_code}")
+        except:
+            traceback.print_exc()
+        return False
+
+    def combination_os_comp(arch: str, failed: list):
+        candidates = []
         for os in os_list:
             for comp in component_list:
                 vardict = {
@@ -241,20 +573,31 @@ def main():
 
                 name = substitute_vars(args.repo_name, vardict)
                 url = substitute_vars(args.base_url, vardict)
-                try:
-                    probe_url = (
-                        url + ("" if url.endswith("/") else "/") + "repodata/repomd.xml"
-                    )
-                    r = requests.head(probe_url, timeout=(30, 60))
-                    if r.status_code < 400 or r.status_code == 403:
-                        yield (name, url)
-                    else:
-                        logger.warning(f"{probe_url} -> {r.status_code}")
-                except:
-                    traceback.print_exc()
-
-    for arch in arch_list:
-        dest_dirs = []
+                probe_url = (
+                    url + ("" if url.endswith("/") else "/") + "repodata/repomd.xml"
+                )
+                candidates.append((name, url, probe_url))
+
+        # probe all repos at once, but report them in the order of the arguments
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=PROBE_WORKERS)
+        futures = [executor.submit(probe, c[2]) for c in candidates]
+        concurrent.futures.wait(futures, timeout=PROBE_TIMEOUT)
+        executor.shutdown(wait=False, cancel_futures=True)
+        for (name, url, probe_url), future in zip(candidates, futures):
+            if not future.done() or future.cancelled():
+                # may be a slow upstream rather than a missing repo
+                logger.error(f"{probe_url} -> no answer in {PROBE_TIMEOUT}s")
+                failed.append((name, arch))
+            elif future.result():
+                yield (name, url)
+
+    def sync_arch(arch: str) -> Tuple[list, list]:
+        """
+        Sync all repos of `arch`, returning the failed ones and the ones whose
+        metadata should be updated
+        """
+        failed = []
+        repos = []
         conf = tempfile.NamedTemporaryFile("w", suffix=".conf")
         conf.write(
             """
@@ -262,7 +605,10 @@ def main():
 keepcache=0
 """
         )
-        for name, url in combination_os_comp(arch):
+        if args.jobs > 1:
+            # dnf locks its cache directory, so concurrent runs need their own
+            conf.write(f"cachedir={tempfile.mkdtemp(dir=cache_dir)}\n")
+        for name, url in combination_os_comp(arch, failed):
             conf.write(
                 f"""
 [{name}]
@@ -275,53 +621,138 @@ enabled=1
             )
             dst = (args.working_dir / name).absolute()
             dst.mkdir(parents=True, exist_ok=True)
-            dest_dirs.append(dst)
+            repos.append((name, url, dst))
         conf.flush()
         # sp.run(["cat", conf.name])
         # sp.run(["ls", "-la", cache_dir])
 
-        if len(dest_dirs) == 0:
+        if len(repos) == 0:
             logger.info("Nothing to sync")
             failed.append(("", arch))
-            continue
-
-        cmd_args = [
-            "dnf",
-            "reposync",
-            "-c",
-            conf.name,
-            "--delete",
-            "-p",
-            str(args.working_dir.absolute()),
-        ]
-        if args.pass_arch_to_reposync:
-            cmd_args += ["--arch", arch]
-        logger.info(f"Launching dnf reposync with command: {cmd_args}")
-        ret = sp.run(cmd_args)
-        if ret.returncode != 0:
-            failed.append((name, arch))
-            continue
-
-        for path in dest_dirs:
-            path.mkdir(exist_ok=True)
-            if args.download_repodata:
-                download_repodata(url, path)
-            else:
-                shutil.rmtree(".repodata", True)
-                cmd_args = [
-                    "createrepo_c",
-                    "--update",
-                    "-v",
-                    "-c",
-                    cache_dir,
-                    "-o",
-                    str(path),
-                    str(path),
-                ]
-                logger.info(f"Launching createrepo with command: {cmd_args}")
-                ret = sp.run(cmd_args)
-            calc_repo_size(path)
+            return failed, []
+
+        if args.native:
+            synced = []
+            for name, url, dst in repos:
+                logger.info(f"Syncing {url} to {dst}")
+                if (
+                    native_sync(
+                        url,
+                        dst,
+                        arch if args.pass_arch_to_reposync else None,
+                        args.workers,
+                    )
+                    != 0
+                ):
+                    failed.append((name, arch))
+                else:
+                    synced.append((name, url, dst))
+            repos = synced
+        else:
+            cmd_args = [
+                "dnf",
+                "reposync",
+                "-c",
+                conf.name,
+                "--delete",
+                "-p",
+                str(args.working_dir.absolute()),
+            ]
+            if args.pass_arch_to_reposync:
+                cmd_args += ["--arch", arch]
+            logger.info(f"Launching dnf reposync with command: {cmd_args}")
+            ret = sp.run(cmd_args)
+            if ret.returncode != 0:
+                failed.append((name, arch))
+                return failed, []
+        return failed, repos
+
+    path_locks: Dict[Path, threading.Lock] = {}
+    path_locks_lock = threading.Lock()
+
+    def update_metadata(name: str, url: str, path: Path):
+        # arches may share a directory, which must not be indexed twice at once
+        with path_locks_lock:
+            lock = path_locks.setdefault(path, threading.Lock())
+        with lock:
+            _update_metadata(name, url, path)
+
+    def _update_metadata(name: str, url: str, path: Path):
+        path.mkdir(exist_ok=True)
+        fingerprint = repo_fingerprint(path)
+        prev = repo_state.get(path.name, {})
+        metadata_ok = True
+        if args.download_repodata:
+            metadata_ok = download_repodata(url, path) != 1
+        elif (
+            prev.get("packages") == fingerprint
+            and repomd_stamp(path) == prev.get("repomd")
+        ):
+            logger.info(f"Packages in {path} unchanged, skipping createrepo_c")
+        else:
+            shutil.rmtree(path / ".repodata", True)
+            # one cache per directory, as createrepo_c may run concurrently
+            repo_cache_dir = Path(cache_dir) / name
+            repo_cache_dir.mkdir(exist_ok=True)
+            cmd_args = [
+                "createrepo_c",
+                "--update",
+                "-v",
+                "-c",
+                str(repo_cache_dir),
+                "-o",
+                str(path),
+                str(path),
+            ]
+            logger.info(f"Launching createrepo with command: {cmd_args}")
+            ret = sp.run(cmd_args)
+            metadata_ok = ret.returncode == 0
+        stamp = repomd_stamp(path)
+        if (
+            prev.get("packages") == fingerprint
+            and stamp == prev.get("repomd")
+            and "size" in prev
+        ):
+            logger.info(f"Repository {path} unchanged:")
+            logger.info(f"  {prev['count']} packages, {prev['size']} bytes in total")
+            REPO_STAT[str(path)] = (prev["size"], prev["count"])
+            return
+        calc_repo_size(path)
+        if metadata_ok and str(path) in REPO_STAT:
+            size, cnt = REPO_STAT[str(path)]
+            repo_state[path.name] = {
+                "packages": fingerprint,
+                "repomd": stamp,
+                "size": size,
+                "count": cnt,
+            }
+
+    # arches are synced --jobs at a time, and the metadata of every synced
+    # directory is updated as soon as its arch is done
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        arch_futures = [executor.submit(sync_arch, arch) for arch in arch_list]
+        metadata_futures = []
+        for future in concurrent.futures.as_completed(arch_futures):
+            try:
+                _, repos = future.result()
+            except:
+                traceback.print_exc()
+                continue
+            for repo in repos:
+                metadata_futures.append(executor.submit(update_metadata, *repo))
+        for arch, future in zip(arch_list, arch_futures):
+            # keep failed in the order of the arguments
+            try:
+                failed.extend(future.result()[0])
+            except:
+                failed.append(("", arch))
+        for future in metadata_futures:
+            try:
+                future.result()
+            except:
+                traceback.print_exc()
 
+    save_repo_state(state_file, repo_state)
     if len(failed) > 0:
         logger.error(f"Failed YUM repos: {failed}")
     else: